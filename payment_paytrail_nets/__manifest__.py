@@ -21,20 +21,29 @@
 {
     "name": "Payment Provider: Paytrail",
     "summary": "Add Paytrail as a payment provider",
-    "version": "17.0.1.2.2",
+    "version": "17.0.1.3.0",
     "development_status": "Production/Stable",
     "category": "Accounting/Payment Providers",
     "website": "https://github.com/Tawasta/paytrail",
     "author": "Futural",
     "license": "LGPL-3",
-    "depends": ["payment"],
+    "depends": ["payment", "product"],
     "data": [
+        "security/ir.model.access.csv",
         "view/payment_method_template.xml",
         "view/payment_provider_views.xml",
         "view/payment_template.xml",
+        "view/product_template_views.xml",
+        "view/paytrail_settlement_views.xml",
         "data/payment_provider_data.xml",
         "data/payment_method_data.xml",
+        "data/ir_cron_data.xml",
     ],
+    "assets": {
+        "web.assets_frontend": [
+            "payment_paytrail_nets/static/src/js/payment_form.js",
+        ],
+    },
     "images": ["static/description/banner.png"],
     "demo": [],
     "installable": True,
@@ -0,0 +1,108 @@
+API_URL = "https://services.paytrail.com"
+
+# System parameter that overrides the API URL, e.g. to use a local mock server
+API_URL_PARAM = "payment_paytrail_nets.api_url"
+
+# Seconds to wait for the TCP/TLS connection and for the response, respectively
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# Retry policy for the pooled HTTP sessions. Only idempotent requests are retried
+# on error statuses, connection errors are retried for every method as the request
+# never reached Paytrail.
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = (502, 503, 504)
+RETRY_METHODS = ("GET",)
+
+# Size of the keep-alive connection pool per merchant account
+POOL_MAXSIZE = 10
+
+# Threads per worker for payments created in the background
+BACKGROUND_WORKERS = 4
+
+# Seconds between reloads of the page shown while a payment is being created
+PENDING_REFRESH_INTERVAL = 1
+
+# Seconds after which the page gives up waiting for a payment that is being
+# created in the background, e.g. if the job was lost with its worker
+PENDING_TIMEOUT = 60
+
+# Processed notifications are remembered for a while, so that duplicates of the
+# same notification (browser redirect, callback and its retries) are skipped
+NOTIFICATION_CACHE_TTL = 600
+NOTIFICATION_CACHE_SIZE = 10000
+
+# Transaction state that each Paytrail status leads to
+STATUS_MAPPING = {
+    "ok": "done",
+    "fail": "cancel",
+    "pending": "pending",
+    "delayed": "pending",
+}
+
+# Queued callbacks processed per commit
+NOTIFICATION_BATCH_SIZE = 500
+# Queued callbacks that fail, e.g. on a concurrent update of the transaction,
+# are processed again after NOTIFICATION_RETRY_DELAY seconds, doubled for each
+# attempt, until NOTIFICATION_MAX_ATTEMPTS attempts have failed
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 30
+
+# Reconciliation of transactions that are waiting for a Paytrail callback
+RECONCILE_STALE_MINUTES = 30
+# Transactions older than this are abandoned and no longer reconciled
+RECONCILE_MAX_AGE_DAYS = 7
+RECONCILE_BATCH_SIZE = 200
+RECONCILE_MAX_WORKERS = 8
+
+# Hours before the stored payment method catalogue is fetched again
+METHOD_CATALOGUE_TTL_HOURS = 24
+
+# Minutes a created payment is reused for identical payloads
+PAYMENT_CACHE_TTL_MINUTES = 30
+
+# Seconds a payment being created in advance blocks creating it again
+PRECREATE_IN_FLIGHT_TTL = 60
+
+# Pace of requests per merchant account, shared by all workers of the server.
+# Interactive requests wait at most RATE_LIMIT_MAX_WAIT seconds, requests sent
+# in bulk wait as long as needed.
+RATE_LIMIT_PER_SECOND = 50
+RATE_LIMIT_BURST = 100
+RATE_LIMIT_MAX_WAIT = 2
+
+# After this many consecutive failed requests, requests fail fast without
+# contacting Paytrail for CIRCUIT_COOLDOWN_SECONDS
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_SECONDS = 30
+
+# Import of settlements and payment reports. Rows are matched to transactions
+# and written in batches of SETTLEMENT_BATCH_SIZE.
+SETTLEMENT_IMPORT_DAYS = 7
+SETTLEMENT_BATCH_SIZE = 1000
+STREAM_CHUNK_SIZE = 65536
+PAYMENT_REPORT_FIELDS = ("transactionId", "stamp", "status", "amount")
+
+# Creation of payment links for invoices in bulk
+INVOICE_LINK_BATCH_SIZE = 500
+INVOICE_LINK_MAX_WORKERS = 8
+
+# Requests sent in batches that fail on connection errors, server errors or
+# throttling are retried after BATCH_BACKOFF seconds, doubled for each retry
+BATCH_RETRIES = 3
+BATCH_BACKOFF = 2
+
+# Charging token payments in bulk
+TOKEN_CHARGE_BATCH_SIZE = 200
+TOKEN_CHARGE_MAX_WORKERS = 8
+
+# Acquirer response codes of soft declines, e.g. insufficient funds or issuer
+# unavailable, which may succeed when charged again on a later run. Other
+# declines are final, as are soft declines after TOKEN_CHARGE_MAX_SOFT_DECLINES.
+SOFT_DECLINE_CODES = ("05", "51", "61", "65", "91", "96")
+TOKEN_CHARGE_MAX_SOFT_DECLINES = 3
+
+# Sending refunds in bulk
+REFUND_BATCH_SIZE = 200
+REFUND_MAX_WORKERS = 8
@@ -1,11 +1,18 @@
+import csv
+import io
 import werkzeug
 import logging
 import hmac
+from datetime import timedelta
 from werkzeug.exceptions import Forbidden
 
-from odoo import http
+from odoo import _, fields, http
+from odoo.exceptions import UserError, ValidationError
 from odoo.http import request
 
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment_paytrail_nets import const, metrics as paytrail_metrics
+
 _logger = logging.getLogger(__name__)
 
 
@@ -14,6 +21,11 @@ class PaytrailController(http.Controller):
 
     _success_url = "/payment/paytrail/success"
     _cancel_url = "/payment/paytrail/cancel"
+    _pending_url = "/payment/paytrail/pending"
+    _tokenization_url = "/payment/paytrail/tokenization"
+    _callback_url = "/payment/paytrail/callback"
+    _report_url = "/payment/paytrail/report"
+    _precreate_url = "/payment/paytrail/precreate"
 
     @http.route(
         [_success_url, _cancel_url],
@@ -23,23 +35,57 @@ class PaytrailController(http.Controller):
     def paytrail_return_from_checkout(self, **data):
         """ """
         _logger.info(f"Handling redirection from Paytrail with data\n{data}")
+        # Authenticate the notification before looking up its transaction
+        provider_sudo = self._get_notification_provider(data)
+        self._verify_notification_signature(data, provider_sudo)
+        _logger.debug("Signature %s valid!", data["signature"])
         tx_sudo = (
             request.env["payment.transaction"]
             .sudo()
             ._get_tx_from_notification_data("paytrail", data)
         )
-        self._verify_notification_signature(data, tx_sudo)
-        _logger.debug(f"Signature {data['signature']} valid!")
-        tx_sudo._handle_notification_data("paytrail", data)
+        if not tx_sudo._paytrail_is_notification_merchant(data):
+            _logger.warning(
+                "Notification for tx %s sent by another merchant", tx_sudo.reference
+            )
+            raise Forbidden()
+        if tx_sudo._paytrail_is_notification_processed(data):
+            _logger.info(
+                "Notification for tx %s already processed, skipping", tx_sudo.reference
+            )
+        else:
+            tx_sudo._handle_notification_data("paytrail", data)
+            tx_sudo._paytrail_set_notification_processed(data)
         return request.redirect("/payment/status")
 
     @staticmethod
-    def _verify_notification_signature(notification_data, tx_sudo):
+    def _get_notification_provider(notification_data):
+        """Get the provider of the merchant account that sent the notification.
+
+        :param dict notification_data: The notification data
+        :return: The sudoed provider, as a `payment.provider` record
+        :raise: :class:`werkzeug.exceptions.Forbidden` if the account is unknown
+        """
+        provider_sudo = (
+            request.env["payment.provider"]
+            .sudo()
+            ._paytrail_get_provider_by_merchant(
+                notification_data.get("checkout-account")
+            )
+        )
+        if not provider_sudo:
+            _logger.warning("Received notification for unknown Paytrail account")
+            raise Forbidden()
+        return provider_sudo
+
+    @staticmethod
+    @paytrail_metrics.timed("verify_signature")
+    def _verify_notification_signature(notification_data, provider_sudo):
         """Check that the received signature matches the expected one.
 
         :param dict notification_data: The notification data
-        :param recordset tx_sudo: The sudoed transaction referenced by the notification data, as a
-                                  `payment.transaction` record
+        :param recordset provider_sudo: The sudoed provider that signed the
+                                        notification, as a `payment.provider` record
         :return: None
         :raise: :class:`werkzeug.exceptions. Forbidden` if the signatures don't match
         """
@@ -50,13 +96,99 @@ class PaytrailController(http.Controller):
             raise Forbidden()
 
         # Compare the received signature with the expected signature computed from the data
-        expected_signature = tx_sudo.provider_id._paytrail_compute_signature(
+        expected_signature = provider_sudo._paytrail_compute_signature(
             notification_data, ""
         )
         if not hmac.compare_digest(received_signature, expected_signature):
             _logger.warning("Received notification with invalid signature")
             raise Forbidden()
 
+    @http.route(
+        [_callback_url],
+        type="http",
+        auth="public",
+        csrf=False,
+        save_session=False,
+    )
+    def paytrail_callback(self, **data):
+        """Handle a server callback from Paytrail by queueing it.
+
+        Only the signature is verified here, so that Paytrail gets its response
+        right away. The notification is processed by a scheduled action.
+        """
+        provider_sudo = self._get_notification_provider(data)
+        self._verify_notification_signature(data, provider_sudo)
+
+        if not request.env["payment.transaction"]._paytrail_is_notification_cached(
+            data
+        ):
+            request.env["paytrail.notification"].sudo()._enqueue(data)
+        return request.make_response("")
+
+    @http.route(
+        [_precreate_url],
+        type="json",
+        auth="public",
+        website=True,
+    )
+    def paytrail_precreate(self, provider_id):
+        """Create the Paytrail payment of the cart in the background when the
+        payment page is loaded, if enabled on the provider."""
+        website = getattr(request, "website", None)
+        if not website or not hasattr(website, "sale_get_order"):
+            return False
+        order = website.sale_get_order()
+        if (
+            not order
+            or order.state != "draft"
+            or order.currency_id.is_zero(order.amount_total)
+        ):
+            return False
+
+        provider_sudo = request.env["payment.provider"].sudo().browse(int(provider_id))
+        if (
+            not provider_sudo.exists()
+            or provider_sudo.code != "paytrail"
+            or provider_sudo.state == "disabled"
+            or not provider_sudo.paytrail_precreate_payments
+        ):
+            return False
+
+        try:
+            return (
+                request.env["payment.transaction"]
+                .sudo()
+                ._paytrail_precreate_payment(provider_sudo, order.sudo())
+            )
+        except (UserError, ValidationError) as e:
+            _logger.debug("Paytrail payment not created in advance: %s", e)
+            return False
+
+    @http.route(
+        [f"{_report_url}/<int:provider_id>/<string:access_token>"],
+        type="http",
+        auth="public",
+        methods=["POST"],
+        csrf=False,
+        save_session=False,
+    )
+    def paytrail_payment_report(self, provider_id, access_token, **kwargs):
+        """Import a payment report sent by Paytrail. The CSV is read as a
+        stream, row by row."""
+        if not payment_utils.check_access_token(access_token, provider_id):
+            raise Forbidden()
+        provider_sudo = request.env["payment.provider"].sudo().browse(provider_id)
+        if not provider_sudo.exists() or provider_sudo.code != "paytrail":
+            raise Forbidden()
+
+        files = list(request.httprequest.files.values())
+        stream = files[0].stream if files else request.httprequest.stream
+        rows = csv.DictReader(io.TextIOWrapper(stream, "utf-8-sig", newline=""))
+        request.env["paytrail.settlement"].sudo()._import_payment_report(
+            provider_sudo, rows
+        )
+        return request.make_response("")
+
     @http.route(
         ["/payment/paytrail/redirect"],
         type="http",
@@ -65,3 +197,99 @@ class PaytrailController(http.Controller):
     )
     def paytrail_redirect(self, url, **kwargs):
         return werkzeug.utils.redirect(url)
+
+    @http.route(
+        [_pending_url],
+        type="http",
+        auth="public",
+        csrf=False,
+    )
+    def paytrail_pending(self, reference, access_token, **kwargs):
+        """Wait for a payment that is being created in the background.
+
+        The page reloads itself until the Paytrail payment URL is available and
+        then redirects the customer to it. If the payment is not created in time,
+        the transaction is set to error and the customer is shown its status.
+        """
+        if not payment_utils.check_access_token(access_token, reference):
+            raise Forbidden()
+
+        tx_sudo = (
+            request.env["payment.transaction"]
+            .sudo()
+            .search(
+                [("reference", "=", reference), ("provider_code", "=", "paytrail")],
+                limit=1,
+            )
+        )
+        if not tx_sudo:
+            raise Forbidden()
+
+        if tx_sudo.paytrail_payment_url:
+            return werkzeug.utils.redirect(tx_sudo.paytrail_payment_url)
+        if tx_sudo.state != "draft":
+            return request.redirect("/payment/status")
+        if tx_sudo.create_date < fields.Datetime.now() - timedelta(
+            seconds=const.PENDING_TIMEOUT
+        ):
+            _logger.warning(
+                "Paytrail payment of tx %s was not created in time", reference
+            )
+            tx_sudo._set_error(_("Paytrail: Payment creation timed out"))
+            return request.redirect("/payment/status")
+
+        return request.render(
+            "payment_paytrail_nets.pending_page",
+            {
+                "refresh_interval": const.PENDING_REFRESH_INTERVAL,
+                "refresh_url": request.httprequest.full_path,
+            },
+        )
+
+    @http.route(
+        [_tokenization_url],
+        type="http",
+        auth="public",
+        csrf=False,
+    )
+    def paytrail_return_from_tokenization(self, reference, access_token, **data):
+        """Handle the return from the Paytrail form for adding a card: save the
+        card as a token and charge the payment with it. A return that has
+        already been processed only shows the payment status."""
+        if not payment_utils.check_access_token(access_token, reference):
+            raise Forbidden()
+
+        tx_sudo = (
+            request.env["payment.transaction"]
+            .sudo()
+            .search(
+                [("reference", "=", reference), ("provider_code", "=", "paytrail")],
+                limit=1,
+            )
+        )
+        if not tx_sudo:
+            raise Forbidden()
+        self._verify_notification_signature(data, tx_sudo.provider_id)
+        if not tx_sudo._paytrail_is_tokenization_pending():
+            # Already processed, e.g. the customer reloaded the page
+            return request.redirect("/payment/status")
+
+        redirect_url = tx_sudo._paytrail_process_tokenization(data)
+        if redirect_url:
+            return werkzeug.utils.redirect(redirect_url)
+        return request.redirect("/payment/status")
+
+    @http.route(
+        ["/payment/paytrail/metrics"],
+        type="http",
+        auth="user",
+    )
+    def paytrail_metrics(self, **kwargs):
+        """Timing, query count and HTTP status metrics of the Paytrail stages
+        handled by this worker, in Prometheus text format."""
+        if not request.env.user.has_group("base.group_system"):
+            raise Forbidden()
+        return request.make_response(
+            paytrail_metrics.render_prometheus(),
+            headers=[("Content-Type", "text/plain; version=0.0.4")],
+        )
@@ -0,0 +1,126 @@
+import functools
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+# Worker-level counters, keyed by stage
+_durations = defaultdict(float)
+_counts = defaultdict(int)
+_queries = defaultdict(int)
+_errors = defaultdict(int)
+# Worker-level counters of HTTP responses, keyed by (method, status)
+_http_statuses = defaultdict(int)
+_lock = threading.Lock()
+
+
+@contextmanager
+def measure(stage, cr=None):
+    """
+    Measure duration and query count of a Paytrail stage. Results are added to
+    the worker-level counters and logged as a structured line.
+
+    The yielded dict can be used to record the HTTP method and status of the
+    stage, with keys "method" and "status".
+
+    :param stage: string
+    :param cr: database cursor, used for the query count
+    """
+    info = {}
+    queries_before = cr.sql_log_count if cr is not None else 0
+    start = time.perf_counter()
+    error = False
+    try:
+        yield info
+    except Exception:
+        error = True
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        queries = cr.sql_log_count - queries_before if cr is not None else 0
+        status = info.get("status")
+        with _lock:
+            _durations[stage] += duration
+            _counts[stage] += 1
+            _queries[stage] += queries
+            if error:
+                _errors[stage] += 1
+            if status is not None:
+                _http_statuses[(info.get("method", ""), status)] += 1
+        _logger.info(
+            "paytrail_stage stage=%s duration_ms=%.1f queries=%s status=%s error=%s",
+            stage,
+            duration * 1000,
+            queries,
+            status or "-",
+            error,
+        )
+
+
+def timed(stage):
+    """
+    Decorator measuring a function as a Paytrail stage. The cursor for the query
+    count is taken from the first argument that has an environment.
+
+    :param stage: string
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cr = next(
+                (arg.env.cr for arg in args if hasattr(arg, "env")),
+                None,
+            )
+            with measure(stage, cr):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render_prometheus():
+    """
+    Render the counters of this worker in Prometheus text format
+
+    :return: string
+    """
+    pid = os.getpid()
+    lines = [
+        "# HELP paytrail_stage_duration_seconds Time spent in Paytrail stages",
+        "# TYPE paytrail_stage_duration_seconds summary",
+    ]
+    with _lock:
+        for stage in sorted(_counts):
+            labels = f'stage="{stage}",pid="{pid}"'
+            lines += [
+                f"paytrail_stage_duration_seconds_sum{{{labels}}} {_durations[stage]}",
+                f"paytrail_stage_duration_seconds_count{{{labels}}} {_counts[stage]}",
+            ]
+        lines += [
+            "# HELP paytrail_stage_queries_total SQL queries run in Paytrail stages",
+            "# TYPE paytrail_stage_queries_total counter",
+        ]
+        for stage in sorted(_queries):
+            labels = f'stage="{stage}",pid="{pid}"'
+            lines.append(f"paytrail_stage_queries_total{{{labels}}} {_queries[stage]}")
+        lines += [
+            "# HELP paytrail_stage_errors_total Paytrail stages that raised an error",
+            "# TYPE paytrail_stage_errors_total counter",
+        ]
+        for stage in sorted(_errors):
+            labels = f'stage="{stage}",pid="{pid}"'
+            lines.append(f"paytrail_stage_errors_total{{{labels}}} {_errors[stage]}")
+        lines += [
+            "# HELP paytrail_http_responses_total Responses from Paytrail API",
+            "# TYPE paytrail_http_responses_total counter",
+        ]
+        for (method, status), count in sorted(_http_statuses.items()):
+            labels = f'method="{method}",status="{status}",pid="{pid}"'
+            lines.append(f"paytrail_http_responses_total{{{labels}}} {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,16 @@
+from odoo import SUPERUSER_ID, api
+
+
+def migrate(cr, version):
+    """
+    Enable tokenization of the Paytrail payment method. Its data is in a
+    noupdate file, so it is not changed when the module is updated.
+
+    :param cr: database cursor
+    :param version: string, installed version of the module
+    :return: None
+    """
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    payment_method = env.ref("payment.payment_method_paytrail", False)
+    if payment_method:
+        payment_method.support_tokenization = True
@@ -1,2 +1,6 @@
+from . import paytrail_notification
+from . import paytrail_payment_cache
+from . import paytrail_settlement
 from . import payment_provider
 from . import payment_transaction
+from . import product_template
@@ -1,13 +1,38 @@
+import hmac
+import json
 import logging
 import requests
 import uuid
-import hmac
-import hashlib
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from odoo import Command, api, fields, models, tools, _
+from odoo.exceptions import UserError, ValidationError
 
-from odoo import api, fields, models, _
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment_paytrail_nets import (
+    const,
+    metrics as paytrail_metrics,
+    utils as paytrail_utils,
+)
+from odoo.addons.payment_paytrail_nets.controllers.main import PaytrailController
 
 _logger = logging.getLogger(__name__)
 
+# Fields whose change clears the cached configuration and merchant lookup
+PAYTRAIL_CACHED_FIELDS = (
+    "code",
+    "state",
+    "paytrail_merchant_id",
+    "paytrail_merchant_secret",
+    "paytrail_base_url",
+    "paytrail_shop_in_shop",
+    "paytrail_default_sub_merchant_id",
+    "paytrail_show_provider_buttons",
+    "paytrail_async_payment_creation",
+    "paytrail_queue_callbacks",
+)
+
 
 class PaymentProvider(models.Model):
     _inherit = "payment.provider"
@@ -37,27 +62,98 @@ class PaymentProvider(models.Model):
         "Can be toggled on if dealing with e.g. invoices that have originated from "
         "Contracts and do not have a Sale Order.",
     )
+    paytrail_shop_in_shop = fields.Boolean(
+        string="Shop-in-Shop",
+        help="Split payments between sub-merchants. Merchant ID and secret must "
+        "be those of the Shop-in-Shop aggregate merchant. Each item is paid to the "
+        "sub-merchant of its product.",
+    )
+    paytrail_default_sub_merchant_id = fields.Char(
+        string="Default Sub-merchant ID",
+        help="Shop-in-Shop sub-merchant for items whose product has no "
+        "sub-merchant, e.g. shipping and rounding.",
+    )
+    paytrail_method_catalogue = fields.Text(
+        string="Payment method catalogue",
+        readonly=True,
+        copy=False,
+    )
+    paytrail_method_catalogue_date = fields.Datetime(
+        string="Payment method catalogue updated",
+        readonly=True,
+        copy=False,
+    )
+    paytrail_method_catalogue_etag = fields.Char(
+        string="Payment method catalogue ETag",
+        readonly=True,
+        copy=False,
+    )
+    paytrail_show_provider_buttons = fields.Boolean(
+        string="Show Bank Buttons",
+        help="Show the banks and wallets of the payment directly after the customer "
+        "clicks Pay, so the customer goes straight to the bank without the Paytrail "
+        "payment page. Not used when payments are created in background.",
+    )
+    paytrail_precreate_payments = fields.Boolean(
+        string="Create Payments in Advance",
+        help="Create the Paytrail payment of the cart when the payment page is "
+        "loaded, so that the customer is sent to Paytrail right away when they "
+        "click Pay. A new payment is created if the cart changes.",
+    )
+    paytrail_queue_callbacks = fields.Boolean(
+        string="Queue Callbacks",
+        help="Answer Paytrail server callbacks right away and process them in a "
+        "scheduled action, so that slow order confirmation does not make Paytrail "
+        "time out and send the callback again.",
+    )
+    paytrail_refund_by_email = fields.Boolean(
+        string="Email Refunds",
+        help="If Paytrail rejects a refund, e.g. because the payment method does "
+        "not support refunds, request it by email instead. Paytrail asks the "
+        "customer for a bank account, and the refund is paid there.",
+    )
+    paytrail_async_payment_creation = fields.Boolean(
+        string="Create Payments in Background",
+        help="Create the Paytrail payment in a background thread and show the "
+        "customer a waiting page until the payment page is available, instead of "
+        "keeping the web worker waiting for Paytrail API.",
+    )
 
     def _get_default_base_url(self):
         return self.env["ir.config_parameter"].get_param("web.base.url")
 
-    def _get_paytrail_headers(self, payload):
+    def _compute_feature_support_fields(self):
+        """Override of `payment` to enable additional features."""
+        res = super()._compute_feature_support_fields()
+        self.filtered(lambda p: p.code == "paytrail").update(
+            {
+                "support_refund": "partial",
+                "support_tokenization": True,
+            }
+        )
+        return res
+
+    def _get_paytrail_headers(self, payload, method=None, checkout_headers=None):
         """
         Get Paytrail headers
 
-        :param payload: dict
+        :param payload: JSON bytes, empty for requests without a body
+        :param method: string, HTTP method. Defaults to POST if there is a payload
+        :param checkout_headers: dict, additional "checkout-" headers to sign
         :return: dict
         """
         headers = {
-            "checkout-account": str(self.paytrail_merchant_id),
+            "checkout-account": self._paytrail_get_config().merchant_id,
             "checkout-algorithm": "sha256",
-            "checkout-method": "GET",
+            "checkout-method": method or "GET",
             "checkout-nonce": str(uuid.uuid4()),
             "checkout-timestamp": fields.Datetime.now().isoformat(),
             "platform-name": "futural_odoo",
         }
+        if checkout_headers:
+            headers.update(checkout_headers)
 
-        if payload != "":
+        if payload:
             # If request has a body, set content type and change checkout method to POST
             headers["content-type"] = "application/json; charset=utf-8"
             headers["checkout-method"] = "POST"
@@ -70,70 +166,376 @@ class PaymentProvider(models.Model):
         Get Paytrail HMAC signature
 
         :param headers: dict
-        :param payload: dict
+        :param payload: string or bytes
         :return: string
         """
-        # Calculation uses all headers named "checkout-" in alphabetical order
-        checkout_headers = [k for k, v in headers.items() if k.startswith("checkout-")]
-        checkout_headers.sort()
+        return self._paytrail_get_signer().sign(headers, payload)
 
-        hmac_string = "\n".join(f"{key}:{headers[key]}" for key in checkout_headers)
-        hmac_string += f"\n{payload}"
-        signature = hmac.new(
-            self.paytrail_merchant_secret.encode("utf-8"),
-            hmac_string.encode("utf-8"),
-            hashlib.sha256,
-        ).hexdigest()
-        return signature
+    def _paytrail_get_signer(self):
+        """
+        Get the signer of the provider, keyed with the merchant secret
 
-    def action_paytrail_update_method_brands(self):
+        :return: PaytrailSigner
+        """
+        return self._paytrail_get_config().signer
+
+    @tools.ormcache("self.id")
+    def _paytrail_get_config(self):
+        """
+        Get a snapshot of the Paytrail configuration of the provider. Cached per
+        worker, and cleared on all workers when the configuration is changed.
+
+        :return: PaytrailConfig
+        """
         self.ensure_one()
+        return paytrail_utils.PaytrailConfig(
+            merchant_id=str(self.paytrail_merchant_id),
+            signer=paytrail_utils.PaytrailSigner(self.paytrail_merchant_secret or ""),
+            base_url=self.paytrail_base_url,
+            api_url=self._paytrail_get_api_url(),
+            shop_in_shop=self.paytrail_shop_in_shop,
+            default_sub_merchant_id=self.paytrail_default_sub_merchant_id,
+            show_provider_buttons=self.paytrail_show_provider_buttons,
+            async_payment_creation=self.paytrail_async_payment_creation,
+            queue_callbacks=self.paytrail_queue_callbacks,
+        )
 
-        self.env.ref("payment.payment_method_paytrail").active = True
+    @api.model
+    def _paytrail_get_provider_by_merchant(self, merchant_id):
+        """
+        Get the active Paytrail provider of a merchant account, e.g. to verify
+        a notification before looking up its transaction
 
-        headers = self._get_paytrail_headers("")
-        r = requests.get(
-            "https://services.paytrail.com/merchants/payment-providers", headers=headers
+        :param merchant_id: string, the checkout-account of the notification
+        :return: payment.provider, empty if the account is unknown
+        """
+        return self.browse(
+            self._paytrail_get_provider_ids_by_merchant().get(merchant_id)
         )
 
-        if r.status_code == 200:
-            paytrail_methods = r.json()
-            _logger.info(_("Found %s supported payment methods", len(paytrail_methods)))
-            payment_method = self.env["payment.method"]
-
-            active_methods = []
-            for paytrail_method in paytrail_methods:
-                method_id = payment_method.with_context(active_test=False).search(
-                    [
-                        "|",
-                        ("name", "=ilike", paytrail_method.get("name")),
-                        ("code", "=ilike", paytrail_method.get("name")),
-                    ],
-                    limit=1,
+    @api.model
+    @tools.ormcache()
+    def _paytrail_get_provider_ids_by_merchant(self):
+        """
+        Get the ids of the active Paytrail providers by merchant account. The
+        accounts are cached per worker as a whole, so that notifications for
+        unknown accounts add nothing to the cache. Cleared when Paytrail
+        providers are changed.
+
+        Companies may share a merchant account. The secret is then the same,
+        and the first provider of the account is used.
+
+        :return: dict of merchant id: provider id
+        """
+        providers = (
+            self.sudo()
+            .with_context(active_test=False)
+            .search_fetch(
+                [("code", "=", "paytrail"), ("state", "!=", "disabled")],
+                ["paytrail_merchant_id"],
+                order="id",
+            )
+        )
+        provider_ids = {}
+        for provider in providers:
+            if provider.paytrail_merchant_id:
+                provider_ids.setdefault(provider.paytrail_merchant_id, provider.id)
+        return provider_ids
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        providers = super().create(vals_list)
+        if any(provider.code == "paytrail" for provider in providers):
+            self.env.registry.clear_cache()
+        return providers
+
+    def write(self, vals):
+        res = super().write(vals)
+        if any(field in vals for field in PAYTRAIL_CACHED_FIELDS):
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        paytrail_providers = self.filtered(lambda p: p.code == "paytrail")
+        res = super().unlink()
+        if paytrail_providers:
+            self.env.registry.clear_cache()
+        return res
+
+    def _paytrail_get_api_url(self):
+        """
+        Get Paytrail API URL. Can be overridden with a system parameter, e.g. for
+        testing against a local mock server
+
+        :return: string
+        """
+        return (
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param(const.API_URL_PARAM, const.API_URL)
+            .rstrip("/")
+        )
+
+    def _paytrail_verify_response_signature(self, response):
+        """
+        Check that a response from Paytrail API is signed with the merchant secret
+
+        :param response: requests.Response
+        :return: bool
+        """
+        headers = {key.lower(): value for key, value in response.headers.items()}
+        signature = headers.get("signature")
+        if not signature:
+            return False
+        expected_signature = self._paytrail_compute_signature(headers, response.content)
+        return hmac.compare_digest(signature, expected_signature)
+
+    def _paytrail_iter_verified_content(self, response):
+        """
+        Iterate over the content of a streamed response from Paytrail API while
+        verifying its signature. The signature is checked once all content has
+        been read, so nothing must be committed before that.
+
+        :param response: requests.Response, requested with stream=True
+        :return: generator of bytes
+        :raise: ValidationError if the signature is invalid
+        """
+        headers = {key.lower(): value for key, value in response.headers.items()}
+        mac = self._paytrail_get_signer().start(headers)
+        for chunk in response.iter_content(chunk_size=const.STREAM_CHUNK_SIZE):
+            mac.update(chunk)
+            yield chunk
+        if not hmac.compare_digest(headers.get("signature", ""), mac.hexdigest()):
+            raise ValidationError(
+                "Paytrail: " + _("Invalid signature in the response from Paytrail.")
+            )
+
+    def _paytrail_prepare_request(
+        self,
+        endpoint,
+        payload="",
+        method=None,
+        extra_headers=None,
+        checkout_headers=None,
+    ):
+        """
+        Prepare a signed request to Paytrail API. The result holds plain values
+        only, so it can be sent outside of the ORM, e.g. from a background thread
+
+        :param endpoint: string, e.g. "/payments"
+        :param payload: JSON bytes, empty for requests without a body
+        :param method: string, HTTP method. Defaults to POST if there is a payload
+        :param extra_headers: dict, unsigned headers to add to the request
+        :param checkout_headers: dict, additional "checkout-" headers to sign
+        :return: dict
+        """
+        self.ensure_one()
+
+        if not method:
+            method = "POST" if payload else "GET"
+
+        headers = self._get_paytrail_headers(payload, method, checkout_headers)
+        if extra_headers:
+            headers.update(extra_headers)
+
+        config = self._paytrail_get_config()
+        return {
+            "merchant_id": config.merchant_id,
+            "method": method,
+            "url": f"{config.api_url}{endpoint}",
+            "headers": headers,
+            "data": payload or None,
+        }
+
+    def _paytrail_make_request(
+        self,
+        endpoint,
+        payload="",
+        method=None,
+        extra_headers=None,
+        checkout_headers=None,
+        stream=False,
+    ):
+        """
+        Make a request to Paytrail API using the pooled session of the merchant
+
+        :param endpoint: string, e.g. "/payments"
+        :param payload: JSON bytes, empty for requests without a body
+        :param method: string, HTTP method. Defaults to POST if there is a payload
+        :param extra_headers: dict, unsigned headers to add to the request
+        :param checkout_headers: dict, additional "checkout-" headers to sign
+        :param stream: bool, if set, the content is read only when iterated over
+        :return: requests.Response
+        :raise: ValidationError if the API could not be reached
+        """
+        prepared_request = self._paytrail_prepare_request(
+            endpoint, payload, method, extra_headers, checkout_headers
+        )
+        try:
+            with paytrail_metrics.measure("http_request") as info:
+                info["method"] = prepared_request["method"]
+                response = paytrail_utils.send_request(
+                    **prepared_request, stream=stream
+                )
+                info["status"] = response.status_code
+        except paytrail_utils.PaytrailUnavailable as e:
+            _logger.warning("Request to %s not sent: %s", prepared_request["url"], e)
+            raise ValidationError(
+                "Paytrail: "
+                + _(
+                    "The payment service is temporarily unavailable. "
+                    "Please try again in a moment."
                 )
-                if method_id:
-                    paytrail_method = self.env.ref("payment.payment_method_paytrail")
-                    if (
-                        not method_id.active
-                        and method_id.primary_payment_method_id != paytrail_method
-                    ):
-                        # Change the payment method for this brand
-                        method_id.primary_payment_method_id = paytrail_method.id
-
-                    method_id.active = True
-                    active_methods.append(method_id.name)
-                else:
-                    _logger.warning(
-                        _(
-                            "Could not find payment method %s",
-                            paytrail_method.get("name"),
-                        )
-                    )
-        else:
+            ) from e
+        except requests.exceptions.RequestException as e:
+            _logger.exception(
+                "Unable to reach endpoint at %s: %s", prepared_request["url"], e
+            )
+            raise ValidationError(
+                "Paytrail: " + _("Could not establish the connection to the API.")
+            ) from e
+
+        return response
+
+    def _paytrail_get_tokenization_form_params(self, success_url, cancel_url, language):
+        """
+        Get the signed parameters of the Paytrail form where the customer adds
+        a card for tokenization
+
+        :param success_url: string
+        :param cancel_url: string
+        :param language: string, language code
+        :return: list of (name, value) tuples
+        """
+        self.ensure_one()
+        params = {
+            "checkout-account": self._paytrail_get_config().merchant_id,
+            "checkout-algorithm": "sha256",
+            "checkout-method": "POST",
+            "checkout-nonce": str(uuid.uuid4()),
+            "checkout-timestamp": fields.Datetime.now().isoformat(),
+            "checkout-redirect-success-url": success_url,
+            "checkout-redirect-cancel-url": cancel_url,
+            "language": language,
+        }
+        params["signature"] = self._paytrail_compute_signature(params, "")
+        return list(params.items())
+
+    def _paytrail_get_card_token(self, tokenization_id):
+        """
+        Get the card token and card details of an added card
+
+        :param tokenization_id: string, checkout-tokenization-id of the card
+        :return: dict
+        :raise: ValidationError if the token could not be fetched
+        """
+        self.ensure_one()
+        r = self._paytrail_make_request(
+            f"/tokenization/{tokenization_id}",
+            method="POST",
+            checkout_headers={"checkout-tokenization-id": tokenization_id},
+        )
+        data = paytrail_utils.parse_response(r)
+        if r.status_code != 200 or not data.get("token"):
+            _logger.error("Error while fetching card token: %s", r.text)
+            raise ValidationError(
+                "Paytrail: " + _("The card could not be saved for later payments.")
+            )
+        return data
+
+    def _paytrail_get_method_catalogue(self, force_refresh=False):
+        """
+        Get the payment methods supported by the merchant. The catalogue is
+        stored on the provider and only fetched again from Paytrail after it
+        has expired, using a conditional request when possible.
+
+        :param force_refresh: bool, ignore the expiry of the stored catalogue
+        :return: list of dicts, or None if the catalogue could not be fetched
+        """
+        self.ensure_one()
+
+        now = fields.Datetime.now()
+        catalogue_valid = (
+            self.paytrail_method_catalogue
+            and self.paytrail_method_catalogue_date
+            and self.paytrail_method_catalogue_date
+            > now - timedelta(hours=const.METHOD_CATALOGUE_TTL_HOURS)
+        )
+        if catalogue_valid and not force_refresh:
+            return json.loads(self.paytrail_method_catalogue)
+
+        extra_headers = {}
+        if self.paytrail_method_catalogue and self.paytrail_method_catalogue_etag:
+            extra_headers["If-None-Match"] = self.paytrail_method_catalogue_etag
+
+        r = self._paytrail_make_request(
+            "/merchants/payment-providers", extra_headers=extra_headers
+        )
+
+        if r.status_code == 304:
+            self.paytrail_method_catalogue_date = now
+            return json.loads(self.paytrail_method_catalogue)
+        if r.status_code != 200:
             _logger.error(_("Error while fetching providers: %s", r.text))
+            return None
+
+        self.write(
+            {
+                "paytrail_method_catalogue": r.text,
+                "paytrail_method_catalogue_date": now,
+                "paytrail_method_catalogue_etag": r.headers.get("ETag"),
+            }
+        )
+        return r.json()
+
+    def _paytrail_apply_method_catalogue(self, paytrail_methods):
+        """
+        Enable the payment method brands found in the catalogue
+
+        :param paytrail_methods: list of dicts
+        :return: payment.method, the enabled brands
+        """
+        paytrail_method = self.env.ref("payment.payment_method_paytrail")
+        paytrail_method.active = True
+
+        # Map both names and codes to methods, first one in the default order wins
+        methods_by_key = {}
+        for method in (
+            self.env["payment.method"].with_context(active_test=False).search([])
+        ):
+            methods_by_key.setdefault((method.name or "").lower(), method)
+            methods_by_key.setdefault((method.code or "").lower(), method)
+
+        methods = self.env["payment.method"]
+        for brand in paytrail_methods:
+            method = methods_by_key.get((brand.get("name") or "").lower())
+            if method:
+                methods |= method
+            else:
+                _logger.warning(
+                    _("Could not find payment method %s", brand.get("name"))
+                )
+
+        inactive_methods = methods.filtered(lambda m: not m.active)
+        # Change the payment method for these brands
+        inactive_methods.filtered(
+            lambda m: m.primary_payment_method_id != paytrail_method
+        ).write({"primary_payment_method_id": paytrail_method.id})
+        inactive_methods.write({"active": True})
+
+        return methods
+
+    def action_paytrail_update_method_brands(self):
+        self.ensure_one()
+
+        active_methods = self.env["payment.method"]
+        paytrail_methods = self._paytrail_get_method_catalogue()
+        if paytrail_methods is not None:
+            _logger.info(_("Found %s supported payment methods", len(paytrail_methods)))
+            active_methods = self._paytrail_apply_method_catalogue(paytrail_methods)
 
         title = _("Payment method brands enabled!")
-        message = ", ".join(active_methods)
+        message = ", ".join(active_methods.mapped("name"))
         return {
             "type": "ir.actions.client",
             "tag": "display_notification",
@@ -143,3 +545,262 @@ class PaymentProvider(models.Model):
                 "sticky": False,
             },
         }
+
+    @api.constrains("paytrail_shop_in_shop", "paytrail_default_sub_merchant_id")
+    def _check_paytrail_shop_in_shop(self):
+        for provider in self:
+            if (
+                provider.paytrail_shop_in_shop
+                and not provider.paytrail_default_sub_merchant_id
+            ):
+                raise ValidationError(
+                    _("Shop-in-Shop requires a default sub-merchant ID")
+                )
+
+    @api.model
+    def _cron_paytrail_update_method_brands(self):
+        """
+        Enable the payment method brands of all active Paytrail providers, using
+        the stored catalogues while they are valid
+
+        :return: None
+        """
+        providers = self.search(
+            [("code", "=", "paytrail"), ("state", "!=", "disabled")]
+        )
+        for provider in providers:
+            try:
+                paytrail_methods = provider._paytrail_get_method_catalogue()
+            except ValidationError as e:
+                _logger.warning("Could not update brands of %s: %s", provider.name, e)
+                continue
+            if paytrail_methods is not None:
+                provider._paytrail_apply_method_catalogue(paytrail_methods)
+
+    def _paytrail_create_invoice_payment_links(self, invoices):
+        """
+        Create Paytrail payments for invoices in bulk, e.g. after a contract
+        invoicing run. A transaction is created for each invoice, and its
+        Paytrail payment URL is stored in `paytrail_payment_url` for sending
+        to the customer.
+
+        Only posted invoices with nothing paid are handled, as the payment is
+        formed from the whole invoice. Invoices that already have a Paytrail
+        payment link waiting to be paid are skipped, so the method can be run
+        again for the same invoices.
+
+        Invoices are handled in batches: data of the batch is prefetched, the
+        payments are created concurrently at a limited pace and the batch is
+        committed at once.
+
+        :param invoices: account.move
+        :return: payment.transaction, the created transactions
+        """
+        self.ensure_one()
+        if not self.paytrail_send_invoice_data_if_no_sale_order:
+            raise UserError(
+                _(
+                    "Sending invoice data must be enabled on the provider "
+                    "to create payment links for invoices"
+                )
+            )
+
+        transactions = self.env["payment.transaction"]
+        linked_invoices = transactions.search(
+            [
+                ("provider_id", "=", self.id),
+                ("invoice_ids", "in", invoices.ids),
+                ("state", "in", ["draft", "pending"]),
+                ("paytrail_payment_url", "!=", False),
+            ]
+        ).invoice_ids
+        invoices = invoices.filtered(
+            lambda invoice: invoice.state == "posted"
+            and invoice.payment_state == "not_paid"
+            and invoice not in linked_invoices
+        )
+
+        for batch_start in range(0, len(invoices), const.INVOICE_LINK_BATCH_SIZE):
+            batch = invoices[batch_start : batch_start + const.INVOICE_LINK_BATCH_SIZE]
+            transactions |= self._paytrail_create_invoice_payment_links_batch(batch)
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+        return transactions
+
+    def _paytrail_create_invoice_payment_links_batch(self, invoices):
+        """
+        Create Paytrail payments for a batch of invoices
+
+        :param invoices: account.move
+        :return: payment.transaction
+        """
+        Transaction = self.env["payment.transaction"]
+        payment_method = self.env.ref("payment.payment_method_paytrail")
+
+        transactions = Transaction.create(
+            [
+                {
+                    "provider_id": self.id,
+                    "payment_method_id": payment_method.id,
+                    "reference": Transaction._compute_reference(
+                        self.code,
+                        prefix=invoice.name,
+                        invoice_ids=[Command.set(invoice.ids)],
+                    ),
+                    "amount": invoice.amount_residual,
+                    "currency_id": invoice.currency_id.id,
+                    "partner_id": invoice.partner_id.id,
+                    "invoice_ids": [Command.set(invoice.ids)],
+                    "operation": "online_redirect",
+                }
+                for invoice in invoices
+            ]
+        )
+
+        # Read the line data of all invoices at once, so forming the payloads
+        # below is served from the cache
+        transactions._get_paytrail_items_from_lines(
+            invoices.invoice_line_ids.filtered(
+                lambda line: line.display_type != "line_note"
+            ),
+            "move_id",
+            "quantity",
+            "tax_ids",
+        )
+
+        # Invoices whose payment cannot be formed, e.g. because the address of
+        # the customer is missing, must not stop the others
+        sent_transactions = Transaction
+        prepared_requests = []
+        for tx in transactions:
+            try:
+                payload = tx._form_paytrail_payment_json(
+                    {"reference": tx.reference, "billing_partner": tx.partner_id}
+                )
+            except Exception as e:
+                _logger.warning(
+                    "Could not form Paytrail payment of tx %s: %s", tx.reference, e
+                )
+                tx._set_error(
+                    "Paytrail: " + _("Could not form the payment of the invoice.")
+                )
+                continue
+            sent_transactions |= tx
+            prepared_requests.append(
+                self._paytrail_prepare_request("/payments", payload)
+            )
+
+        responses = paytrail_utils.send_requests(
+            prepared_requests, const.INVOICE_LINK_MAX_WORKERS
+        )
+        for tx, response in zip(sent_transactions, responses):
+            if isinstance(response, Exception):
+                data = {"status": "error", "message": str(response)}
+            else:
+                data = paytrail_utils.parse_response(response)
+            tx._paytrail_process_payment_response(data)
+
+        return transactions
+
+    def _paytrail_import_settlements(self, start_date, end_date):
+        """
+        Import the settlements paid to the merchant between the dates. The
+        response is parsed as a stream, settlement by settlement.
+
+        :param start_date: date
+        :param end_date: date
+        :return: paytrail.settlement, the imported settlements
+        :raise: ValidationError if the settlements could not be fetched
+        """
+        self.ensure_one()
+        query = urlencode(
+            {"startDate": start_date.isoformat(), "endDate": end_date.isoformat()}
+        )
+        response = self._paytrail_make_request(
+            f"/settlements?{query}", method="GET", stream=True
+        )
+        if response.status_code != 200:
+            data = paytrail_utils.parse_response(response)
+            raise ValidationError(
+                "Paytrail: " + data.get("message", _("Could not fetch settlements"))
+            )
+
+        with response:
+            settlements = paytrail_utils.iter_json_array(
+                self._paytrail_iter_verified_content(response)
+            )
+            return self.env["paytrail.settlement"]._import_settlements(
+                self, settlements
+            )
+
+    def _paytrail_request_payment_report(self, start_date, end_date):
+        """
+        Request a report of the payments between the dates. Paytrail sends the
+        report later to the report URL, where it is imported.
+
+        :param start_date: date
+        :param end_date: date
+        :return: None
+        :raise: ValidationError if the report could not be requested
+        """
+        self.ensure_one()
+        report_url = "{}{}/{}/{}".format(
+            self.paytrail_base_url,
+            PaytrailController._report_url,
+            self.id,
+            payment_utils.generate_access_token(self.id),
+        )
+        payload = paytrail_utils.encode_payload(
+            {
+                "requestType": "csv",
+                "callbackUrl": report_url,
+                "startDate": start_date.isoformat(),
+                "endDate": end_date.isoformat(),
+                "reportFields": list(const.PAYMENT_REPORT_FIELDS),
+            }
+        )
+        response = self._paytrail_make_request("/payments/report", payload)
+        if response.status_code not in (200, 201):
+            data = paytrail_utils.parse_response(response)
+            raise ValidationError(
+                "Paytrail: "
+                + data.get("message", _("Could not request payment report"))
+            )
+
+    @api.model
+    def _cron_paytrail_import_settlements(self):
+        """
+        Import the recent settlements of all active Paytrail providers.
+        Settlements that have already been imported are skipped.
+
+        :return: None
+        """
+        end_date = fields.Date.today()
+        start_date = end_date - timedelta(days=const.SETTLEMENT_IMPORT_DAYS)
+        providers = self.search(
+            [("code", "=", "paytrail"), ("state", "!=", "disabled")]
+        )
+        for provider in providers:
+            try:
+                with self.env.cr.savepoint():
+                    provider._paytrail_import_settlements(start_date, end_date)
+            except ValidationError as e:
+                _logger.warning(
+                    "Could not import settlements of %s: %s", provider.name, e
+                )
+                continue
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def action_paytrail_view_settlements(self):
+        """
+        Show the imported settlements of the provider
+
+        :return: dict, action
+        """
+        self.ensure_one()
+        action = self.env["ir.actions.act_window"]._for_xml_id(
+            "payment_paytrail_nets.action_paytrail_settlement"
+        )
+        action["domain"] = [("provider_id", "=", self.id)]
+        return action
@@ -1,24 +1,122 @@
 import logging
-import json
+import time
 import uuid
+from datetime import timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
 import requests
 
-from odoo import _, fields, models
-from odoo.exceptions import ValidationError
+from odoo import SUPERUSER_ID, Command, _, api, fields, models
+from odoo.exceptions import UserError, ValidationError
 from odoo.http import request
+from odoo.modules.registry import Registry
 
 from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment_paytrail_nets import (
+    const,
+    metrics as paytrail_metrics,
+    utils as paytrail_utils,
+)
 from odoo.addons.payment_paytrail_nets.controllers.main import PaytrailController
 
 _logger = logging.getLogger(__name__)
 
+# Worker-level cache of notifications that have already been processed
+_processed_notifications = paytrail_utils.TTLCache(
+    const.NOTIFICATION_CACHE_TTL, const.NOTIFICATION_CACHE_SIZE
+)
+
+
+def _create_payment_in_background(dbname, tx_id, prepared_request, payload_hash):
+    """
+    Send a prepared payment creation request and store the result on the
+    transaction with a new cursor. Runs in the background executor.
+
+    :param dbname: string
+    :param tx_id: int, payment.transaction id
+    :param prepared_request: dict, see PaymentProvider._paytrail_prepare_request
+    :param payload_hash: string, hash of the payload for reusing the payment
+    :return: None
+    """
+    try:
+        response = paytrail_utils.send_request(**prepared_request)
+        data = paytrail_utils.parse_response(response)
+    except requests.exceptions.RequestException as e:
+        _logger.warning("Unable to create Paytrail payment in background: %s", e)
+        data = {"status": "error", "message": "Could not connect to Paytrail"}
+    except Exception:
+        _logger.exception("Unable to create Paytrail payment in background")
+        data = {"status": "error", "message": "Could not connect to Paytrail"}
+
+    try:
+        with Registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            tx = env["payment.transaction"].browse(tx_id).exists()
+            # The pending page gives up on the payment after a while
+            if tx and tx.state == "draft":
+                tx._paytrail_process_payment_response(data, payload_hash)
+    except Exception:
+        _logger.exception("Unable to store Paytrail payment of tx %s", tx_id)
+
+
+# Worker-level set of payloads whose payment is being created in advance
+_precreating_payments = paytrail_utils.TTLCache(
+    const.PRECREATE_IN_FLIGHT_TTL, const.NOTIFICATION_CACHE_SIZE
+)
+
+
+def _precreate_payment_in_background(
+    dbname, provider_id, prepared_request, payload_hash, stamp, reference
+):
+    """
+    Create a payment in advance and cache it for the transaction that is created
+    when the customer clicks Pay. Runs in the background executor.
+
+    :param dbname: string
+    :param provider_id: int, payment.provider id
+    :param prepared_request: dict, see PaymentProvider._paytrail_prepare_request
+    :param payload_hash: string, hash of the payload
+    :param stamp: string, stamp of the payload
+    :param reference: string, reference of the future transaction
+    :return: None
+    """
+    try:
+        response = paytrail_utils.send_request(**prepared_request)
+        data = paytrail_utils.parse_response(response)
+        if response.status_code != 201 or not data.get("href"):
+            _logger.info(
+                "Paytrail payment for %s not created in advance: %s",
+                reference,
+                data.get("message"),
+            )
+            return
+
+        with Registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env["paytrail.payment.cache"]._cache_payment(
+                env["payment.provider"].browse(provider_id),
+                payload_hash,
+                stamp,
+                data,
+                reference=reference,
+            )
+    except requests.exceptions.RequestException as e:
+        _logger.info("Paytrail payment for %s not created in advance: %s", reference, e)
+    except Exception:
+        _logger.exception("Unable to create Paytrail payment in advance")
+    finally:
+        _precreating_payments.pop(payload_hash)
+
 
 class PaymentTransaction(models.Model):
     _inherit = "payment.transaction"
 
+    provider_reference = fields.Char(index="btree_not_null")
+
     paytrail_checkout_stamp = fields.Char(
         string="Paytrail checkout stamp",
         readonly=True,
+        index="btree_not_null",
     )
 
     paytrail_checkout_account = fields.Char(
@@ -31,6 +129,24 @@ class PaymentTransaction(models.Model):
         readonly=True,
     )
 
+    paytrail_payment_url = fields.Char(
+        string="Paytrail payment URL",
+        readonly=True,
+    )
+
+    paytrail_item_amounts = fields.Json(
+        string="Paytrail item amounts",
+        readonly=True,
+        copy=False,
+    )
+
+    paytrail_soft_declines = fields.Integer(
+        readonly=True,
+        copy=False,
+        help="Times the token charge of the payment has been soft declined",
+    )
+
+    @paytrail_metrics.timed("form_validate")
     def _paytrail_form_validate(self, data):
         """
         Validate transaction
@@ -38,7 +154,7 @@ class PaymentTransaction(models.Model):
         :param data: dict
         :return: None
         """
-        _logger.debug(f"Paytrail response data: {data}")
+        _logger.debug("Paytrail response data: %s", data)
         paytrail_status = data.get("checkout-status")
 
         res = {
@@ -47,7 +163,10 @@ class PaymentTransaction(models.Model):
             "paytrail_checkout_account": data.get("checkout-account"),
             "paytrail_checkout_provider": data.get("checkout-provider"),
         }
-        self.write(res)
+        # Only write values that have changed, to avoid needless row updates
+        res = {key: value for key, value in res.items() if self[key] != value}
+        if res:
+            self.write(res)
 
         if paytrail_status == "fail":
             _logger.info(
@@ -72,19 +191,206 @@ class PaymentTransaction(models.Model):
 
         return
 
+    def _paytrail_is_notification_merchant(self, data):
+        """
+        Check that a notification was sent by the merchant account of the
+        provider of the transaction. Companies may share a merchant account, so
+        the transaction found may belong to another provider of the same account.
+
+        :param data: dict
+        :return: bool
+        """
+        self.ensure_one()
+        merchant_id = self.provider_id._paytrail_get_config().merchant_id
+        return merchant_id == data.get("checkout-account")
+
+    def _paytrail_get_notification_key(self, data):
+        """
+        Get the key identifying a Paytrail notification
+
+        :param data: dict
+        :return: tuple
+        """
+        return (
+            self.env.cr.dbname,
+            data.get("checkout-transaction-id"),
+            data.get("checkout-status"),
+        )
+
+    def _paytrail_is_notification_processed(self, data):
+        """
+        Check if the same notification has already been processed, either in this
+        worker or as seen from the transaction state
+
+        :param data: dict
+        :return: bool
+        """
+        self.ensure_one()
+        if self._paytrail_is_notification_cached(data):
+            return True
+
+        expected_state = const.STATUS_MAPPING.get(data.get("checkout-status"))
+        return bool(
+            expected_state
+            and self.state == expected_state
+            and self.provider_reference == data.get("checkout-transaction-id")
+        )
+
+    @api.model
+    def _paytrail_is_notification_cached(self, data):
+        """
+        Check if the same notification has already been processed in this worker.
+        Does not query the database.
+
+        :param data: dict
+        :return: bool
+        """
+        return self._paytrail_get_notification_key(data) in _processed_notifications
+
+    def _paytrail_set_notification_processed(self, data):
+        """
+        Remember that a notification has been processed, once the current
+        transaction has been committed. A notification whose processing is rolled
+        back, e.g. on a serialization failure, must be processed again.
+
+        :param data: dict
+        :return: None
+        """
+        key = self._paytrail_get_notification_key(data)
+
+        @self.env.cr.postcommit.add
+        def set_notification_processed():
+            _processed_notifications.set(key)
+
+    @api.model
+    def _cron_paytrail_reconcile_transactions(self):
+        """
+        Reconcile stale Paytrail transactions that are still waiting for a
+        callback, by querying their status from Paytrail API. Transactions
+        created more than RECONCILE_MAX_AGE_DAYS ago are left alone.
+
+        Statuses are queried concurrently batch by batch, and the results of each
+        batch are committed together.
+
+        :return: None
+        """
+        now = fields.Datetime.now()
+        stale_date = now - timedelta(minutes=const.RECONCILE_STALE_MINUTES)
+        oldest_date = now - timedelta(days=const.RECONCILE_MAX_AGE_DAYS)
+        txs = self.search(
+            [
+                ("provider_code", "=", "paytrail"),
+                ("state", "in", ["draft", "pending"]),
+                ("provider_reference", "!=", False),
+                ("operation", "!=", "refund"),
+                ("create_date", "<", stale_date),
+                ("create_date", ">=", oldest_date),
+            ]
+        )
+        _logger.info("Reconciling %s Paytrail transactions", len(txs))
+
+        for batch_start in range(0, len(txs), const.RECONCILE_BATCH_SIZE):
+            batch = txs[batch_start : batch_start + const.RECONCILE_BATCH_SIZE]
+            batch._paytrail_reconcile()
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _paytrail_reconcile(self):
+        """
+        Query the payment status of the transactions from Paytrail API and
+        apply it to the transactions
+
+        :return: None
+        """
+        prepared_requests = [
+            tx.provider_id._paytrail_prepare_request(
+                f"/payments/{tx.provider_reference}", method="GET"
+            )
+            for tx in self
+        ]
+        responses = paytrail_utils.send_requests(
+            prepared_requests, const.RECONCILE_MAX_WORKERS
+        )
+
+        for tx, response in zip(self, responses):
+            if isinstance(response, Exception):
+                _logger.warning(
+                    "Could not query Paytrail status for tx %s: %s",
+                    tx.reference,
+                    response,
+                )
+                continue
+            if response.status_code != 200:
+                _logger.warning(
+                    "Could not query Paytrail status for tx %s: %s",
+                    tx.reference,
+                    response.text,
+                )
+                continue
+            if not tx.provider_id._paytrail_verify_response_signature(response):
+                _logger.warning(
+                    "Invalid signature in Paytrail status of tx %s", tx.reference
+                )
+                continue
+
+            data = tx._paytrail_get_notification_data_from_payment(response.json())
+            if data["checkout-status"] not in const.STATUS_MAPPING:
+                # Payment has not been finished (status "new"), nothing to do
+                continue
+            if tx._paytrail_is_notification_processed(data):
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    tx._handle_notification_data("paytrail", data)
+                    tx._paytrail_set_notification_processed(data)
+            except Exception as e:
+                _logger.warning(
+                    "Could not apply Paytrail status to tx %s: %s", tx.reference, e
+                )
+
+    def _paytrail_get_notification_data_from_payment(self, payment):
+        """
+        Convert a payment returned by Paytrail API to notification data
+
+        :param payment: dict
+        :return: dict
+        """
+        return {
+            "checkout-account": self.provider_id.paytrail_merchant_id,
+            "checkout-reference": payment.get("reference"),
+            "checkout-stamp": payment.get("stamp"),
+            "checkout-transaction-id": payment.get("id") or self.provider_reference,
+            "checkout-status": payment.get("status"),
+            "checkout-provider": payment.get("provider"),
+        }
+
     def _get_paytrail_urlset(self):
         """
         Get Paytrail urlset
 
         :return: dict
         """
-        base_url = self.provider_id.paytrail_base_url
+        base_url = self.provider_id._paytrail_get_config().base_url
         res = {
             "success": f"{base_url}{PaytrailController._success_url}",
             "cancel": f"{base_url}{PaytrailController._cancel_url}",
         }
         return res
 
+    def _get_paytrail_callback_urlset(self):
+        """
+        Get the urlset of Paytrail server callbacks. Callbacks are queued if
+        enabled on the provider.
+
+        :return: dict
+        """
+        config = self.provider_id._paytrail_get_config()
+        if not config.queue_callbacks:
+            return self._get_paytrail_urlset()
+
+        callback_url = f"{config.base_url}{PaytrailController._callback_url}"
+        return {"success": callback_url, "cancel": callback_url}
+
     def _get_payment_language(self, values):
         """
         Set payment language for Paytrail
@@ -102,7 +408,8 @@ class PaymentTransaction(models.Model):
         else:
             return "EN"
 
-    def _form_paytrail_payment_json(self, values):
+    @paytrail_metrics.timed("form_payload")
+    def _form_paytrail_payment_json(self, values, extra_values=None, stamp=None):
         """
         Forms paytrail payment params, supports fetching data from either
         - Sale Order (primary, always attempted first)
@@ -115,7 +422,10 @@ class PaymentTransaction(models.Model):
         want to send a payment link to the customer.
 
         :param values: dict
-        :return: JSON string
+        :param extra_values: dict, additional values for the payload, e.g. the
+            card token of token payments
+        :param stamp: string, stamp of the payment. A new stamp by default.
+        :return: JSON bytes
         """
         if "reference" in values:
             reference = values["reference"]
@@ -127,24 +437,31 @@ class PaymentTransaction(models.Model):
             else:
                 values["reference"] = ""
 
-        transaction = self.env["payment.transaction"].search(
-            [
-                ("reference", "=", values["reference"]),
-                ("state", "in", ["draft", "pending"]),
-            ],
-            order="create_date DESC",
-            limit=1,
-        )
+        if self.reference == values["reference"] and self.state in [
+            "draft",
+            "pending",
+        ]:
+            # Forming the payment for this very transaction, no need to search
+            transaction = self
+        else:
+            transaction = self.env["payment.transaction"].search(
+                [
+                    ("reference", "=", values["reference"]),
+                    ("state", "in", ["draft", "pending"]),
+                ],
+                order="create_date DESC",
+                limit=1,
+            )
 
         # Put together payment data that is common, regardless if data is fetched
         # from SO or invoice
         urlset = self._get_paytrail_urlset()
         res = {
-            "stamp": str(uuid.uuid4()),
+            "stamp": stamp or str(uuid.uuid4()),
             "reference": values["reference"],
             "language": self._get_payment_language(values),
             "redirectUrls": urlset,
-            "callbackUrls": urlset,
+            "callbackUrls": self._get_paytrail_callback_urlset(),
             "usePricesWithoutVat": False,
         }
 
@@ -167,7 +484,9 @@ class PaymentTransaction(models.Model):
 
             res = self._form_paytrail_payment_json_from_invoice(transaction, res)
 
-        # Check if a separate item for rounding should be added
+        # Check if a separate item for rounding should be added. Items are summed
+        # here, after the payload is complete, so that items added by other
+        # modules are included.
         item_prices_total = sum(
             (item["unitPrice"] * item["units"]) for item in res["items"]
         )
@@ -186,7 +505,44 @@ class PaymentTransaction(models.Model):
                 "Total amount and items's summed prices match, rounding item not needed."
             )
 
-        return json.dumps(res, separators=(",", ":"))
+        config = self.provider_id._paytrail_get_config()
+        if config.shop_in_shop:
+            self._paytrail_set_shop_in_shop_values(res)
+        if extra_values:
+            res.update(extra_values)
+
+        # Store the stamp so the transaction can be found directly from callbacks.
+        # Shop-in-Shop items are stored for refunds, which are made per item.
+        transaction_values = {"paytrail_checkout_stamp": res["stamp"]}
+        if config.shop_in_shop:
+            transaction_values["paytrail_item_amounts"] = {
+                item["stamp"]: item["unitPrice"] * item["units"]
+                for item in res["items"]
+            }
+        # Also works for transactions that are not saved yet, see
+        # _paytrail_precreate_payment
+        transaction.update(transaction_values)
+
+        return paytrail_utils.encode_payload(res)
+
+    def _paytrail_set_shop_in_shop_values(self, res):
+        """
+        Set the Shop-in-Shop values of the items: every item gets its own stamp,
+        and items of the same sub-merchant share a reference
+
+        :param res: dict to be sent to paytrail
+        :return: None
+        """
+        config = self.provider_id._paytrail_get_config()
+        default_merchant = config.default_sub_merchant_id
+        for index, item in enumerate(res["items"]):
+            if not item.get("merchant"):
+                item["merchant"] = default_merchant
+            # Derived from the payment stamp, so that identical payloads stay
+            # identical apart from the stamp
+            item["stamp"] = f"{res['stamp']}-{index}"
+            item["reference"] = f"{res['reference']}-{item['merchant']}"
+            item["orderId"] = res.get("orderId", res["reference"])
 
     def _append_rounding_item(self, res, amount_difference):
         """
@@ -318,28 +674,10 @@ class PaymentTransaction(models.Model):
         :param order: sale.order
         :return: list
         """
-        items = []
-        for line in order.order_line:
-            vat_percent = sum(line.tax_id.mapped("amount"))
-            quantity = int(round(line.product_uom_qty, 0))
-            items.append(
-                {
-                    "unitPrice": round(line.price_total * 100 / quantity),
-                    "units": quantity,
-                    "vatPercentage": vat_percent,
-                    "productCode": line.product_id.default_code
-                    or str(line.product_id.id),
-                    "description": line.product_id.name,
-                    "category": line.product_id.categ_id.display_name,
-                    # Shop-in-Shop payments
-                    # "orderId":
-                    # "stamp":
-                    # "reference":
-                    # "merchant":
-                    # "commission":
-                }
-            )
-        return items
+        items = self._get_paytrail_items_from_lines(
+            order.order_line, "order_id", "product_uom_qty", "tax_id"
+        )
+        return items.get(order.id, [])
 
     def _get_paytrail_items_from_invoice(self, invoice):
         """
@@ -348,64 +686,285 @@ class PaymentTransaction(models.Model):
         :param invoice: account.move
         :return: list
         """
+        # Ignore note lines
+        lines = invoice.invoice_line_ids.filtered(
+            lambda line: line.display_type != "line_note"
+        )
+        items = self._get_paytrail_items_from_lines(
+            lines, "move_id", "quantity", "tax_ids", vat_as_int=True
+        )
+        return items.get(invoice.id, [])
 
-        items = []
-        for line in invoice.invoice_line_ids:
-            # Ignore note lines
-            if line.display_type == "line_note":
-                continue
+    def _get_paytrail_items_from_lines(
+        self, lines, parent_field, quantity_field, tax_field, vat_as_int=False
+    ):
+        """
+        Get items for Paytrail payload from sale order or invoice lines.
+
+        All the needed values are read in bulk for the whole recordset, so the
+        number of queries does not depend on the number of lines. Lines may
+        belong to several orders or invoices.
+
+        :param lines: sale.order.line or account.move.line
+        :param parent_field: string, field of the order or invoice on the line
+        :param quantity_field: string, field of the quantity on the line
+        :param tax_field: string, field of the taxes on the line
+        :param vat_as_int: bool, send VAT percentage as an integer
+        :return: dict of item lists, keyed by order or invoice id
+        """
+        provider = self.provider_id[:1]
+        config = provider and provider._paytrail_get_config()
+        shop_in_shop = bool(config and config.shop_in_shop)
+        product_fields = ["default_code", "name", "categ_id"]
+        if shop_in_shop:
+            product_fields += [
+                "paytrail_sub_merchant_id",
+                "paytrail_commission_percent",
+            ]
+
+        line_values = lines.read(
+            [parent_field, quantity_field, tax_field, "price_total", "product_id"],
+            load=False,
+        )
 
-            vat_percent = sum(line.tax_ids.mapped("amount"))
-            quantity = int(round(line.quantity, 0))
-            items.append(
-                {
-                    "unitPrice": round(line.price_total * 100 / quantity),
-                    "units": quantity,
-                    "vatPercentage": int(vat_percent),
-                    "productCode": line.product_id.default_code
-                    or str(line.product_id.id),
-                    "description": line.product_id.name,
-                    "category": line.product_id.categ_id.display_name,
-                    # Shop-in-Shop payments
-                    # "orderId":
-                    # "stamp":
-                    # "reference":
-                    # "merchant":
-                    # "commission":
-                }
-            )
+        tax_ids = {tax_id for values in line_values for tax_id in values[tax_field]}
+        tax_amounts = {
+            values["id"]: values["amount"]
+            for values in self.env["account.tax"].browse(tax_ids).read(["amount"])
+        }
+
+        product_ids = {values["product_id"] for values in line_values} - {False}
+        products = {
+            values["id"]: values
+            for values in self.env["product.product"]
+            .browse(product_ids)
+            .read(product_fields)
+        }
 
+        items = {}
+        for values in line_values:
+            vat_percent = sum(tax_amounts[tax_id] for tax_id in values[tax_field])
+            quantity = int(round(values[quantity_field], 0))
+            product = products.get(values["product_id"], {})
+            category = product.get("categ_id")
+            item = {
+                "unitPrice": round(values["price_total"] * 100 / quantity),
+                "units": quantity,
+                "vatPercentage": int(vat_percent) if vat_as_int else vat_percent,
+                "productCode": product.get("default_code") or str(values["product_id"]),
+                "description": product.get("name", False),
+                "category": category and category[1],
+            }
+            if shop_in_shop:
+                # Shop-in-Shop payments: item is paid to the sub-merchant of the
+                # product, and the aggregate merchant takes a commission
+                item["merchant"] = (
+                    product.get("paytrail_sub_merchant_id")
+                    or config.default_sub_merchant_id
+                )
+                commission_percent = product.get("paytrail_commission_percent")
+                if commission_percent:
+                    item["commission"] = {
+                        "merchant": config.merchant_id,
+                        "amount": round(
+                            item["unitPrice"] * quantity * commission_percent / 100
+                        ),
+                    }
+            items.setdefault(values[parent_field], []).append(item)
         return items
 
+    @paytrail_metrics.timed("create_payment")
     def _get_paytrail_url_token(self, payload):
         """
         Create a new payment with Paytrail API
 
-        :param payload: dict
+        :param payload: JSON bytes
         :return: dict
         """
-        headers = self.provider_id._get_paytrail_headers(payload)
-        uri = "https://services.paytrail.com/payments"
-        _logger.debug(f"Payload: {payload}")
-        _logger.debug(f"Headers: {headers}")
+        _logger.debug("Payload: %s", payload)
 
-        r = requests.post(uri, headers=headers, data=payload)
+        r = self.provider_id._paytrail_make_request("/payments", payload)
+        res = paytrail_utils.parse_response(r)
 
-        if r.status_code == 201:
-            data = r.json()
-            return data
-        else:
-            res = r.json()
+        if r.status_code != 201:
+            msg = f"Error: {res.get('message', 'Unknown error')}"
+            _logger.error(msg)
 
-            try:
-                msg = f"Error: {res['message']}"
-                _logger.error(msg)
-            except Exception as e:
-                msg = "Unknown error: %s" % e
-                _logger.error(msg)
+        return res
+
+    def _paytrail_process_payment_response(self, data, payload_hash=None):
+        """
+        Store the result of a payment creation on the transaction
 
+        :param data: dict, response from Paytrail payment creation
+        :param payload_hash: string, if set, the payment is cached for reuse
+        :return: None
+        """
+        self.ensure_one()
+        if data.get("status") == "error" or not data.get("href"):
+            self._set_error(
+                "Paytrail: " + (data.get("message") or _("Payment creation failed"))
+            )
+            return
+
+        self.write(
+            {
+                "paytrail_payment_url": data["href"],
+                "provider_reference": data.get("transactionId"),
+            }
+        )
+        if payload_hash:
+            self.env["paytrail.payment.cache"].sudo()._cache_payment(
+                self.provider_id,
+                payload_hash,
+                self.paytrail_checkout_stamp,
+                data,
+                transaction=self,
+            )
+
+    def _paytrail_get_cached_payment(self, payload_hash):
+        """
+        Reuse a still valid payment that was created with an identical payload,
+        e.g. when the customer comes back from Paytrail and clicks Pay again.
+        The payment is moved to this transaction with its stamp, so that its
+        callbacks no longer find the earlier attempt.
+
+        :param payload_hash: string
+        :return: dict, response from Paytrail payment creation, or None
+        """
+        self.ensure_one()
+        cached_payment = (
+            self.env["paytrail.payment.cache"]
+            .sudo()
+            ._get_cached_payment(self.provider_id, payload_hash)
+        )
+        if not cached_payment:
+            return None
+
+        _logger.debug("Reusing Paytrail payment for tx %s", self.reference)
+        data = cached_payment._get_response()
+        earlier_tx = cached_payment.transaction_id
+        if earlier_tx and earlier_tx != self:
+            earlier_tx.write(
+                {
+                    "paytrail_checkout_stamp": False,
+                    "paytrail_payment_url": False,
+                    "provider_reference": False,
+                }
+            )
+
+        values = {
+            "paytrail_checkout_stamp": cached_payment.stamp,
+            "paytrail_payment_url": data.get("href"),
+            "provider_reference": cached_payment.paytrail_transaction_id,
+        }
+        if self.paytrail_item_amounts:
+            # Shop-in-Shop item stamps are derived from the payment stamp
+            values["paytrail_item_amounts"] = {
+                item_stamp.replace(
+                    self.paytrail_checkout_stamp, cached_payment.stamp, 1
+                ): amount
+                for item_stamp, amount in self.paytrail_item_amounts.items()
+            }
+        self.write(values)
+        cached_payment.write({"transaction_id": self.id, "reference": self.reference})
+        return data
+
+    def _paytrail_get_redirect_values(self, data):
+        """
+        Get rendering values that send the customer straight to Paytrail, and
+        optionally to the banks and wallets of the payment
+
+        :param data: dict, response from Paytrail payment creation
+        :return: dict
+        """
+        # Paytrail URL is submitted as a GET form, so its query string is passed
+        # as hidden inputs
+        url = urlsplit(data["href"])
+        res = {
+            "paytrail_url": urlunsplit((url.scheme, url.netloc, url.path, "", "")),
+            "paytrail_url_params": parse_qsl(url.query),
+            "paytrail_form_method": "get",
+        }
+        config = self.provider_id._paytrail_get_config()
+        if config.show_provider_buttons and data.get("providers"):
+            res["paytrail_providers"] = data["providers"]
         return res
 
+    def _paytrail_create_payment_in_background(self, payload, payload_hash):
+        """
+        Create the Paytrail payment in the background executor, once the current
+        transaction has been committed
+
+        :param payload: JSON bytes
+        :param payload_hash: string, hash of the payload for reusing the payment
+        :return: None
+        """
+        self.ensure_one()
+        prepared_request = self.provider_id._paytrail_prepare_request(
+            "/payments", payload
+        )
+        dbname = self.env.cr.dbname
+        tx_id = self.id
+
+        @self.env.cr.postcommit.add
+        def create_payment():
+            paytrail_utils.submit_background(
+                _create_payment_in_background,
+                dbname,
+                tx_id,
+                prepared_request,
+                payload_hash,
+            )
+
+    @api.model
+    def _paytrail_precreate_payment(self, provider, order):
+        """
+        Create the Paytrail payment of a sale order in the background when the
+        payment page is loaded. The payment is cached by the hash of its
+        payload, and used if the customer clicks Pay without changing the order.
+
+        The payload is formed for a transaction that is not saved, with the
+        reference that the transaction will get.
+
+        :param provider: payment.provider
+        :param order: sale.order
+        :return: bool, True if the creation was started
+        """
+        reference = self._compute_reference(
+            provider.code, sale_order_ids=[Command.set(order.ids)]
+        )
+        tx = self.new(
+            {
+                "provider_id": provider.id,
+                "reference": reference,
+                "amount": order.amount_total,
+                "currency_id": order.currency_id.id,
+                "partner_id": order.partner_id.id,
+                "sale_order_ids": [Command.set(order.ids)],
+            }
+        )
+        payload = tx._form_paytrail_payment_json({"reference": reference})
+        stamp = tx.paytrail_checkout_stamp
+        payment_cache = self.env["paytrail.payment.cache"]
+        payload_hash = payment_cache._get_payload_hash(tx, payload)
+        if payload_hash in _precreating_payments or payment_cache._get_cached_payment(
+            provider, payload_hash
+        ):
+            return False
+
+        _precreating_payments.set(payload_hash)
+        paytrail_utils.submit_background(
+            _precreate_payment_in_background,
+            self.env.cr.dbname,
+            provider.id,
+            provider._paytrail_prepare_request("/payments", payload),
+            payload_hash,
+            stamp,
+            reference,
+        )
+        return True
+
     def _get_specific_rendering_values(self, processing_values):
         """
         Override of payment to return Paytrail-specific rendering values.
@@ -418,22 +977,776 @@ class PaymentTransaction(models.Model):
             return res
 
         paytrail_tx_values = dict(processing_values)
-        payload = self._form_paytrail_payment_json(paytrail_tx_values)
-        _logger.debug(f"Payload: {payload}")
+        if self.tokenize:
+            # Card is added first, the payment is charged with its token
+            paytrail_tx_values.update(self._paytrail_get_tokenization_values())
+            return paytrail_tx_values
 
-        token = self._get_paytrail_url_token(payload)
-        _logger.debug(f"Token: {token}")
+        payload = self._form_paytrail_payment_json(paytrail_tx_values)
+        payload_hash = self.env["paytrail.payment.cache"]._get_payload_hash(
+            self, payload
+        )
 
-        if token.get("status") == "error":
-            raise ValidationError(token.get("message"))
-        else:
+        token = self._paytrail_get_cached_payment(payload_hash)
+        config = self.provider_id._paytrail_get_config()
+        if token is None and config.async_payment_creation:
+            self._paytrail_create_payment_in_background(payload, payload_hash)
+            params = {
+                "reference": self.reference,
+                "access_token": payment_utils.generate_access_token(self.reference),
+            }
             paytrail_tx_values[
                 "paytrail_url"
-            ] = f"/payment/paytrail/redirect?url={token.get('href')}"
+            ] = f"{PaytrailController._pending_url}?{urlencode(params)}"
+            return paytrail_tx_values
+
+        if token is None:
+            token = self._get_paytrail_url_token(payload)
+            _logger.debug("Token: %s", token)
+
+            # Responses without a payment URL are errors, whatever their status
+            if not token.get("href"):
+                raise ValidationError(
+                    "Paytrail: "
+                    + (token.get("message") or _("Payment creation failed"))
+                )
+            self._paytrail_process_payment_response(token, payload_hash)
+
+        paytrail_tx_values.update(self._paytrail_get_redirect_values(token))
 
-        _logger.debug(f"TX values: {paytrail_tx_values}")
+        _logger.debug("TX values: %s", paytrail_tx_values)
         return paytrail_tx_values
 
+    def _paytrail_get_tokenization_values(self):
+        """
+        Get rendering values that send the customer to the Paytrail form for
+        adding a card
+
+        :return: dict
+        """
+        params = {
+            "reference": self.reference,
+            "access_token": payment_utils.generate_access_token(self.reference),
+        }
+        provider = self.provider_id
+        config = provider._paytrail_get_config()
+        return_url = (
+            f"{config.base_url}"
+            f"{PaytrailController._tokenization_url}?{urlencode(params)}"
+        )
+        language = self._get_payment_language({"billing_partner": self.partner_id})
+        return {
+            "paytrail_url": f"{config.api_url}/tokenization/addcard-form",
+            "paytrail_url_params": provider._paytrail_get_tokenization_form_params(
+                return_url, return_url, language
+            ),
+        }
+
+    def _paytrail_is_tokenization_pending(self):
+        """
+        Check if the transaction is still waiting for the card added on the
+        Paytrail tokenization form
+
+        :return: bool
+        """
+        self.ensure_one()
+        return self.state == "draft" and not self.token_id
+
+    def _paytrail_process_tokenization(self, data):
+        """
+        Save the card the customer added as a token, and charge the payment
+        with it
+
+        :param data: dict, data of the redirect from the tokenization form
+        :return: string, URL for 3D Secure authentication if it is required
+        """
+        self.ensure_one()
+        # The return URL stays valid, so the same return can come again, also
+        # concurrently. Only the first one may save the card and charge it.
+        self.env.cr.execute(
+            "SELECT id FROM payment_transaction WHERE id = %s FOR UPDATE", [self.id]
+        )
+        self.invalidate_recordset(["state", "token_id"])
+        if not self._paytrail_is_tokenization_pending():
+            _logger.info("Tokenization of tx %s already processed", self.reference)
+            return None
+
+        if data.get("checkout-status") != "ok":
+            _logger.info(
+                _("Paytrail tokenization for tx %s: set as canceled", self.reference)
+            )
+            self._set_canceled()
+            return None
+
+        card_data = self.provider_id._paytrail_get_card_token(
+            data.get("checkout-tokenization-id")
+        )
+        card = card_data.get("card", {})
+        token = self.env["payment.token"].create(
+            {
+                "provider_id": self.provider_id.id,
+                "payment_method_id": self.payment_method_id.id,
+                "payment_details": card.get("partial_pan"),
+                "partner_id": self.partner_id.id,
+                "provider_ref": card_data["token"],
+            }
+        )
+        self.write({"token_id": token.id, "tokenize": False})
+        _logger.info(
+            "Created token with id %s for partner with id %s",
+            token.id,
+            self.partner_id.id,
+        )
+
+        self._paytrail_charge_token()
+        if self.state == "pending":
+            return self.paytrail_payment_url
+        return None
+
+    def _paytrail_get_token_charge_payload(self):
+        """
+        Get the endpoint and payload that charge the payment with the card token.
+        Payments of customers in session are customer initiated, others are
+        merchant initiated.
+
+        The stamp of an earlier charge of the transaction is reused, so that
+        Paytrail rejects the charge as a duplicate if the earlier one went
+        through.
+
+        :return: tuple of endpoint and JSON bytes
+        """
+        self.ensure_one()
+        if self.operation == "offline":
+            endpoint = "/payments/token/mit/charge"
+        else:
+            endpoint = "/payments/token/cit/charge"
+        payload = self._form_paytrail_payment_json(
+            {"reference": self.reference, "billing_partner": self.partner_id},
+            extra_values={"token": self.token_id.provider_ref},
+            stamp=self.paytrail_checkout_stamp,
+        )
+        return endpoint, payload
+
+    def _paytrail_prepare_token_charge(self):
+        """
+        Prepare the request that charges the payment with the card token
+
+        :return: dict, see PaymentProvider._paytrail_prepare_request
+        """
+        return self.provider_id._paytrail_prepare_request(
+            *self._paytrail_get_token_charge_payload()
+        )
+
+    def _paytrail_charge_token(self):
+        """
+        Charge the payment with the card token
+
+        :return: None
+        """
+        self.ensure_one()
+        prepared_request = self._paytrail_prepare_token_charge()
+        try:
+            response = paytrail_utils.send_request(**prepared_request)
+        except requests.exceptions.RequestException as e:
+            _logger.warning("Could not charge token of tx %s: %s", self.reference, e)
+            self._set_error("Paytrail: " + _("Could not connect to Paytrail."))
+            return
+        self._paytrail_process_token_charge_response(
+            response.status_code, paytrail_utils.parse_response(response)
+        )
+
+    def _paytrail_process_token_charge_response(self, status_code, data):
+        """
+        Apply the result of a token charge to the transaction
+
+        :param status_code: int, HTTP status of the response
+        :param data: dict, content of the response
+        :return: None
+        """
+        self.ensure_one()
+        if self._paytrail_is_duplicate_stamp(status_code, data):
+            self._paytrail_process_duplicate_charge(data)
+        elif status_code == 201:
+            # Applied like a notification, so that the callbacks of the
+            # transaction are executed and the callback of the same payment
+            # is skipped
+            notification_data = {
+                "checkout-transaction-id": data.get("transactionId"),
+                "checkout-stamp": self.paytrail_checkout_stamp,
+                "checkout-reference": self.reference,
+                "checkout-account": self.provider_id._paytrail_get_config().merchant_id,
+                "checkout-provider": self.paytrail_checkout_provider,
+                "checkout-status": "ok",
+            }
+            if not self._paytrail_is_notification_processed(notification_data):
+                self._handle_notification_data("paytrail", notification_data)
+                self._paytrail_set_notification_processed(notification_data)
+        elif status_code == 403 and data.get("threeDSecureUrl"):
+            # Customer must authenticate the payment, Paytrail redirects back to
+            # the regular return URLs afterwards
+            self.write(
+                {
+                    "provider_reference": data.get("transactionId"),
+                    "paytrail_payment_url": data["threeDSecureUrl"],
+                }
+            )
+            self._set_pending()
+        else:
+            message = data.get("message") or _("Token payment failed")
+            _logger.warning(
+                "Paytrail token charge for tx %s failed: %s", self.reference, message
+            )
+            self._set_error("Paytrail: " + message)
+
+    @api.model
+    def _paytrail_is_duplicate_stamp(self, status_code, data):
+        """
+        Check if Paytrail rejected a request because a payment with its stamp
+        already exists
+
+        :param status_code: int, HTTP status of the response
+        :param data: dict, content of the response
+        :return: bool
+        """
+        message = (data.get("message") or "").lower()
+        return (
+            status_code in (400, 409) and "duplicate" in message and "stamp" in message
+        )
+
+    @api.model
+    def _paytrail_is_soft_decline(self, status_code, data):
+        """
+        Check if a token charge was declined for a reason that may pass when
+        the token is charged again
+
+        :param status_code: int, HTTP status of the response
+        :param data: dict, content of the response
+        :return: bool
+        """
+        return (
+            status_code == 400
+            and data.get("acquirerResponseCode") in const.SOFT_DECLINE_CODES
+        )
+
+    def _paytrail_process_duplicate_charge(self, data):
+        """
+        Handle a token charge that was rejected as a duplicate of its stamp. An
+        earlier attempt, whose response was lost, has created the payment, so
+        the payment is looked up instead of failing the transaction. If it
+        cannot be looked up, the transaction waits for the callback.
+
+        :param data: dict, content of the response
+        :return: None
+        """
+        self.ensure_one()
+        _logger.info(
+            "Paytrail token charge for tx %s was already created", self.reference
+        )
+        transaction_id = data.get("transactionId") or self.provider_reference
+        if transaction_id:
+            self.provider_reference = transaction_id
+            self._paytrail_reconcile()
+        if self.state == "draft":
+            self._set_pending()
+
+    def _paytrail_process_soft_decline(self, data):
+        """
+        Handle a token charge that was soft declined. The declined payment is
+        final at Paytrail, so the transaction is left in draft without a stamp,
+        to be charged with a new stamp on a later run. After
+        TOKEN_CHARGE_MAX_SOFT_DECLINES declines, the transaction is set to error.
+
+        :param data: dict, content of the response
+        :return: None
+        """
+        self.ensure_one()
+        self.paytrail_soft_declines += 1
+        message = data.get("message") or _("Token payment declined")
+        if self.paytrail_soft_declines >= const.TOKEN_CHARGE_MAX_SOFT_DECLINES:
+            _logger.warning(
+                "Paytrail token charge for tx %s declined: %s", self.reference, message
+            )
+            self._set_error("Paytrail: " + message)
+            return
+
+        _logger.info(
+            "Paytrail token charge for tx %s soft declined, charged again on a "
+            "later run: %s",
+            self.reference,
+            message,
+        )
+        self.paytrail_checkout_stamp = False
+
+    def _paytrail_charge_tokens_in_bulk(self):
+        """
+        Charge due token payments, e.g. subscription renewals, in bulk.
+
+        Transactions are charged in batches with a bounded thread pool. The
+        stamps of a batch are committed before it is charged and reused by
+        later runs, so that a payment is never created twice, even if a run is
+        interrupted. Charges that fail because of connection errors, server
+        errors or throttling are retried with exponential backoff. Soft declines
+        are left to a later run. If Paytrail is unavailable, the run stops and
+        the remaining transactions are left in draft.
+
+        :return: None
+        """
+        txs = self.filtered(
+            lambda tx: tx.provider_code == "paytrail"
+            and tx.token_id
+            and tx.state == "draft"
+        )
+        _logger.info("Charging %s Paytrail token payments", len(txs))
+
+        for batch_start in range(0, len(txs), const.TOKEN_CHARGE_BATCH_SIZE):
+            batch = txs[batch_start : batch_start + const.TOKEN_CHARGE_BATCH_SIZE]
+            available = batch._paytrail_charge_tokens_batch()
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+            if not available:
+                _logger.warning(
+                    "Paytrail is unavailable, %s token payments left to a later run",
+                    len(txs) - batch_start - len(batch),
+                )
+                break
+
+    def _paytrail_charge_tokens_batch(self):
+        """
+        Charge a batch of token payments, see _paytrail_charge_tokens_in_bulk
+
+        :return: bool, False if Paytrail was unavailable
+        """
+        # Read the line data of all orders and invoices at once, so forming the
+        # payloads below is served from the cache
+        self._get_paytrail_items_from_lines(
+            self.sale_order_ids.order_line, "order_id", "product_uom_qty", "tax_id"
+        )
+        self._get_paytrail_items_from_lines(
+            self.invoice_ids.invoice_line_ids.filtered(
+                lambda line: line.display_type != "line_note"
+            ),
+            "move_id",
+            "quantity",
+            "tax_ids",
+        )
+
+        payloads = {tx.id: tx._paytrail_get_token_charge_payload() for tx in self}
+        # Charges of an interrupted run are sent again with the same stamps
+        if not self.env.registry.in_test_mode():
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+
+        responses = self._paytrail_send_with_retries(
+            payloads, const.TOKEN_CHARGE_MAX_WORKERS
+        )
+        available = True
+        for tx in self:
+            response = responses[tx.id]
+            if isinstance(response, paytrail_utils.PaytrailUnavailable):
+                available = False
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    tx._paytrail_process_bulk_token_charge_response(response)
+            except Exception:
+                _logger.exception(
+                    "Could not apply Paytrail token charge to tx %s", tx.reference
+                )
+        return available
+
+    def _paytrail_process_bulk_token_charge_response(self, response):
+        """
+        Apply the result of a token charge sent in bulk to the transaction
+
+        :param response: requests.Response, or the exception raised by the
+            request
+        :return: None
+        """
+        self.ensure_one()
+        if isinstance(response, Exception):
+            _logger.warning(
+                "Could not charge token of tx %s: %s", self.reference, response
+            )
+            self._set_error("Paytrail: " + _("Could not connect to Paytrail."))
+            return
+
+        data = paytrail_utils.parse_response(response)
+        if self._paytrail_is_soft_decline(response.status_code, data):
+            self._paytrail_process_soft_decline(data)
+        else:
+            self._paytrail_process_token_charge_response(response.status_code, data)
+
+    def _paytrail_send_with_retries(self, payloads, max_workers):
+        """
+        Send a request for each transaction concurrently. Requests that fail
+        because of connection errors, server errors or throttling are retried
+        with exponential backoff, using the same payload so that nothing is
+        created twice at Paytrail.
+
+        Once the circuit breaker is open, nothing can be sent until its cooldown,
+        which is longer than the backoff. Retries are then given up, and the
+        requests left are returned as not sent.
+
+        :param payloads: dict of transaction id: tuple of endpoint and JSON bytes
+        :param max_workers: int
+        :return: dict of transaction id: requests.Response, or the raised
+            exception if the request failed on every attempt. The exception is
+            PaytrailUnavailable for requests that were not sent.
+        """
+        results = {}
+        pending_txs = self
+        for attempt in range(const.BATCH_RETRIES + 1):
+            if attempt:
+                time.sleep(const.BATCH_BACKOFF * 2 ** (attempt - 1))
+
+            # Headers are signed again for every attempt, for a fresh nonce
+            prepared_requests = [
+                tx.provider_id._paytrail_prepare_request(*payloads[tx.id])
+                for tx in pending_txs
+            ]
+            responses = paytrail_utils.send_requests(prepared_requests, max_workers)
+
+            retry_txs = self.env["payment.transaction"]
+            unavailable = None
+            for tx, response in zip(pending_txs, responses):
+                results[tx.id] = response
+                if isinstance(response, paytrail_utils.PaytrailUnavailable):
+                    unavailable = response
+                elif isinstance(response, Exception) or (
+                    response.status_code >= 500 or response.status_code == 429
+                ):
+                    retry_txs |= tx
+
+            pending_txs = retry_txs
+            if unavailable:
+                for tx in pending_txs:
+                    results[tx.id] = unavailable
+                break
+            if not pending_txs:
+                break
+        return results
+
+    def _send_payment_request(self):
+        """Override of payment to charge the payment with a Paytrail card token.
+
+        Note: self.ensure_one()
+
+        :return: None
+        :raise: UserError if the transaction is not linked to a token
+        """
+        super()._send_payment_request()
+        if self.provider_code != "paytrail":
+            return
+
+        if not self.token_id:
+            raise UserError(
+                "Paytrail: " + _("The transaction is not linked to a token.")
+            )
+        self._paytrail_charge_token()
+
+    def _get_specific_processing_values(self, processing_values):
+        """Override of payment to return the 3D Secure URL of token payments.
+
+        :param dict processing_values: The generic processing values
+        :return: dict
+        """
+        res = super()._get_specific_processing_values(processing_values)
+        if (
+            self.provider_code != "paytrail"
+            or self.operation != "online_token"
+            or self.state != "pending"
+        ):
+            return res
+
+        return {"paytrail_3ds_url": self.paytrail_payment_url}
+
+    def _paytrail_get_refund_payload(self, items=None, email=None):
+        """
+        Get the endpoint and payload of a refund. Called on the refund transaction.
+
+        Shop-in-Shop payments are refunded per item. Unless the items are given,
+        all items of the payment are refunded, which is only possible for full
+        refunds.
+
+        The stamp of an earlier request of the refund is reused, so that
+        Paytrail rejects the refund as a duplicate if the earlier one went
+        through. Refunds by email get a stamp of their own, derived from it.
+
+        :param items: list of dicts with the "stamp" and "amount" of each
+            Shop-in-Shop item to refund
+        :param email: string, if set, Paytrail asks the customer for a bank
+            account by email and the refund is paid there
+        :return: tuple of endpoint and JSON bytes
+        :raise: UserError if the items of a Shop-in-Shop refund are unknown
+        """
+        self.ensure_one()
+        source_tx = self.source_transaction_id
+        stamp = self.paytrail_checkout_stamp or str(uuid.uuid4())
+        # Paytrail may keep the stamp of a refund it rejected
+        refund_stamp = f"{stamp}-email" if email else stamp
+        res = {
+            "amount": payment_utils.to_minor_currency_units(
+                -self.amount, self.currency_id
+            ),
+            "refundStamp": refund_stamp,
+            "refundReference": self.reference,
+            "callbackUrls": self._get_paytrail_callback_urlset(),
+        }
+
+        if self.provider_id.paytrail_shop_in_shop:
+            if items is None:
+                is_full_refund = not self.currency_id.compare_amounts(
+                    -self.amount, source_tx.amount
+                )
+                if not is_full_refund or not source_tx.paytrail_item_amounts:
+                    raise UserError(
+                        "Paytrail: "
+                        + _(
+                            "Give the items to refund for partial refunds of "
+                            "Shop-in-Shop payment %s.",
+                            source_tx.reference,
+                        )
+                    )
+                items = [
+                    {"stamp": stamp, "amount": amount}
+                    for stamp, amount in source_tx.paytrail_item_amounts.items()
+                ]
+            res["items"] = [
+                {
+                    "stamp": item["stamp"],
+                    "amount": item["amount"],
+                    "refundStamp": f"{refund_stamp}-{index}",
+                    "refundReference": f"{self.reference}-{index}",
+                }
+                for index, item in enumerate(items)
+            ]
+
+        endpoint = f"/payments/{source_tx.provider_reference}/refund"
+        if email:
+            endpoint += "/email"
+            res["email"] = email
+
+        # Refund callbacks are found by the stamp like payment callbacks, or by
+        # the Paytrail transaction id for refunds by email
+        self.paytrail_checkout_stamp = stamp
+        return endpoint, paytrail_utils.encode_payload(res)
+
+    def _paytrail_use_email_refund(self, status_code, data):
+        """
+        Check if a refund rejected by Paytrail should be requested by email,
+        e.g. for payment methods that do not support refunds
+
+        :param status_code: int, HTTP status of the rejected refund
+        :param data: dict, content of the response
+        :return: bool
+        """
+        self.ensure_one()
+        return (
+            400 <= status_code < 500
+            and status_code != 429
+            and not self._paytrail_is_duplicate_stamp(status_code, data)
+            and self.provider_id.paytrail_refund_by_email
+            and bool(self.partner_email)
+        )
+
+    def _paytrail_send_refund(self, items=None):
+        """
+        Request the refund from Paytrail. Called on the refund transaction.
+
+        :param items: list of dicts, see _paytrail_get_refund_payload
+        :return: None
+        """
+        self.ensure_one()
+        provider = self.provider_id
+        response = provider._paytrail_make_request(
+            *self._paytrail_get_refund_payload(items=items)
+        )
+        if self._paytrail_use_email_refund(
+            response.status_code, paytrail_utils.parse_response(response)
+        ):
+            response = provider._paytrail_make_request(
+                *self._paytrail_get_refund_payload(
+                    items=items, email=self.partner_email
+                )
+            )
+        self._paytrail_process_refund_response(
+            response.status_code, paytrail_utils.parse_response(response)
+        )
+
+    def _paytrail_process_refund_response(self, status_code, data):
+        """
+        Apply the result of a refund request to the refund transaction
+
+        :param status_code: int, HTTP status of the response
+        :param data: dict, content of the response
+        :return: None
+        """
+        self.ensure_one()
+        if self._paytrail_is_duplicate_stamp(status_code, data):
+            # An earlier request, whose response was lost, has created the
+            # refund. Paytrail sends a callback when it is completed.
+            _logger.info(
+                "Paytrail refund for tx %s was already created", self.reference
+            )
+            if data.get("transactionId"):
+                self.provider_reference = data["transactionId"]
+            self._set_pending()
+            return
+        if status_code != 201:
+            message = data.get("message") or _("Refund failed")
+            _logger.warning(
+                "Paytrail refund for tx %s failed: %s", self.reference, message
+            )
+            self._set_error("Paytrail: " + message)
+            return
+
+        self.provider_reference = data.get("transactionId")
+        if data.get("status") == "ok":
+            self._set_done()
+        else:
+            # Paytrail sends a callback when the refund is completed
+            self._set_pending()
+
+    def _send_refund_request(self, amount_to_refund=None):
+        """Override of payment to send a refund request to Paytrail.
+
+        Items of Shop-in-Shop partial refunds are given in context key
+        "paytrail_refund_items", see _paytrail_get_refund_payload.
+
+        Note: self.ensure_one()
+
+        :param float amount_to_refund: The amount to refund
+        :return: The refund transaction created to process the refund request.
+        :rtype: recordset of `payment.transaction`
+        """
+        refund_tx = super()._send_refund_request(amount_to_refund=amount_to_refund)
+        if self.provider_code != "paytrail":
+            return refund_tx
+
+        refund_tx._paytrail_send_refund(
+            items=self.env.context.get("paytrail_refund_items")
+        )
+        return refund_tx
+
+    def action_paytrail_refund_in_bulk(self):
+        """
+        Fully refund the selected Paytrail payments, e.g. tickets of a cancelled
+        event. Refund transactions are created right away and sent to Paytrail
+        by a scheduled action.
+
+        :return: None
+        """
+        txs = self.filtered(
+            lambda tx: tx.provider_code == "paytrail"
+            and tx.operation != "refund"
+            and tx.state == "done"
+            and not tx.refunds_count
+        )
+        for tx in txs:
+            tx._create_child_transaction(tx.amount, is_refund=True)
+        self.env.ref("payment_paytrail_nets.cron_paytrail_send_refunds")._trigger()
+
+    @api.model
+    def _cron_paytrail_send_refunds(self):
+        """
+        Send the refunds waiting to be sent to Paytrail, in batches that are
+        committed one by one.
+
+        The stamps of a batch are committed before it is sent and reused by
+        later runs, so that a refund is never paid twice, even if a run is
+        interrupted. Refunds that could not be sent, or whose result is not
+        known, are left in draft for the next run. If Paytrail is unavailable,
+        the run stops.
+
+        :return: None
+        """
+        refund_txs = self.search(
+            [
+                ("provider_code", "=", "paytrail"),
+                ("operation", "=", "refund"),
+                ("state", "=", "draft"),
+                ("provider_reference", "=", False),
+            ]
+        )
+        _logger.info("Sending %s Paytrail refunds", len(refund_txs))
+
+        for batch_start in range(0, len(refund_txs), const.REFUND_BATCH_SIZE):
+            batch = refund_txs[batch_start : batch_start + const.REFUND_BATCH_SIZE]
+            available = batch._paytrail_send_refunds_batch()
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+            if not available:
+                _logger.warning(
+                    "Paytrail is unavailable, %s refunds left to the next run",
+                    len(refund_txs) - batch_start - len(batch),
+                )
+                break
+
+    def _paytrail_send_refunds_batch(self):
+        """
+        Send a batch of full refunds concurrently, see _cron_paytrail_send_refunds
+
+        :return: bool, False if Paytrail was unavailable
+        """
+        payloads = {}
+        for tx in self:
+            try:
+                payloads[tx.id] = tx._paytrail_get_refund_payload()
+            except UserError as e:
+                tx._set_error(str(e))
+        # Refunds of an interrupted run are sent again with the same stamps
+        if not self.env.registry.in_test_mode():
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+
+        refund_txs = self.browse(list(payloads))
+        responses = refund_txs._paytrail_send_with_retries(
+            payloads, const.REFUND_MAX_WORKERS
+        )
+
+        # Refunds rejected by Paytrail are requested by email, if enabled
+        email_payloads = {}
+        for tx in refund_txs:
+            response = responses[tx.id]
+            if not isinstance(response, Exception) and tx._paytrail_use_email_refund(
+                response.status_code, paytrail_utils.parse_response(response)
+            ):
+                email_payloads[tx.id] = tx._paytrail_get_refund_payload(
+                    email=tx.partner_email
+                )
+        if email_payloads:
+            responses.update(
+                self.browse(list(email_payloads))._paytrail_send_with_retries(
+                    email_payloads, const.REFUND_MAX_WORKERS
+                )
+            )
+
+        available = True
+        for tx in refund_txs:
+            response = responses[tx.id]
+            if isinstance(response, paytrail_utils.PaytrailUnavailable):
+                available = False
+                continue
+            if isinstance(response, Exception) or (
+                response.status_code >= 500 or response.status_code == 429
+            ):
+                # The refund may have been created, it is sent again with the
+                # same stamp by the next run
+                _logger.warning(
+                    "Could not send Paytrail refund for tx %s: %s",
+                    tx.reference,
+                    response if isinstance(response, Exception) else response.text,
+                )
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    tx._paytrail_process_refund_response(
+                        response.status_code, paytrail_utils.parse_response(response)
+                    )
+            except Exception:
+                _logger.exception(
+                    "Could not apply Paytrail refund to tx %s", tx.reference
+                )
+        return available
+
     def _get_tx_from_notification_data(self, provider_code, notification_data):
         """Override of payment to find the transaction based on Paytrail data.
 
@@ -460,9 +1773,7 @@ class PaymentTransaction(models.Model):
                 )
             )
 
-        tx = self.search(
-            [("reference", "=", reference), ("provider_code", "=", "paytrail")]
-        )
+        tx = self._paytrail_search_tx_from_notification_data(notification_data)
         if not tx:
             raise ValidationError(
                 "Paytrail: "
@@ -471,6 +1782,35 @@ class PaymentTransaction(models.Model):
 
         return tx
 
+    def _paytrail_search_tx_from_notification_data(self, notification_data):
+        """
+        Search the transaction of a notification, using the indexed checkout
+        stamp and Paytrail transaction id before falling back to the reference
+
+        :param dict notification_data: The notification data sent by the provider
+        :return: recordset of `payment.transaction`
+        """
+        stamp = notification_data.get("checkout-stamp")
+        if stamp:
+            tx = self.search([("paytrail_checkout_stamp", "=", stamp)], limit=1)
+            if tx:
+                return tx
+
+        txn_id = notification_data.get("checkout-transaction-id")
+        tx = self.search(
+            [("provider_reference", "=", txn_id), ("provider_code", "=", "paytrail")],
+            limit=1,
+        )
+        if tx:
+            return tx
+
+        return self.search(
+            [
+                ("reference", "=", notification_data.get("checkout-reference")),
+                ("provider_code", "=", "paytrail"),
+            ]
+        )
+
     def _process_notification_data(self, notification_data):
         """Override of payment to process the transaction based on Paytrail data.
 
@@ -480,7 +1820,7 @@ class PaymentTransaction(models.Model):
         :return: None
         :raise: ValidationError if inconsistent data were received
         """
-        _logger.debug(f"Received notification data:\n{notification_data}")
+        _logger.debug("Received notification data:\n%s", notification_data)
         super()._process_notification_data(notification_data)
         if self.provider_code != "paytrail":
             return
@@ -0,0 +1,134 @@
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_paytrail_nets import const
+
+_logger = logging.getLogger(__name__)
+
+
+class PaytrailNotification(models.Model):
+    _name = "paytrail.notification"
+    _description = "Queued Paytrail callback"
+    _order = "id"
+    _log_access = False
+
+    data = fields.Json(required=True)
+    error = fields.Text()
+    attempts = fields.Integer()
+    next_attempt = fields.Datetime()
+
+    @api.model
+    def _enqueue(self, data):
+        """
+        Queue a notification, whose signature has been verified, for processing
+
+        :param data: dict, notification data
+        :return: paytrail.notification
+        """
+        return self.create({"data": data})
+
+    @api.model
+    def _cron_process_notifications(self):
+        """
+        Process the queued notifications in batches that are committed one by
+        one. Processed notifications are removed from the queue. Failed ones
+        are processed again later, and kept with their error once all attempts
+        have failed.
+
+        :return: None
+        """
+        while True:
+            notifications = self.search(
+                [
+                    ("error", "=", False),
+                    "|",
+                    ("next_attempt", "=", False),
+                    ("next_attempt", "<=", fields.Datetime.now()),
+                ],
+                limit=const.NOTIFICATION_BATCH_SIZE,
+            )
+            if not notifications:
+                break
+            notifications._process()
+            if self.env.registry.in_test_mode():
+                break
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _process(self):
+        """
+        Apply the notifications to their transactions
+
+        :return: None
+        """
+        # Find the transactions of the batch with one query
+        stamps = [
+            n.data["checkout-stamp"] for n in self if n.data.get("checkout-stamp")
+        ]
+        txs_by_stamp = {
+            tx.paytrail_checkout_stamp: tx
+            for tx in self.env["payment.transaction"].search(
+                [("paytrail_checkout_stamp", "in", stamps)]
+            )
+        }
+
+        processed = self.browse()
+        for notification in self:
+            data = notification.data
+            try:
+                with self.env.cr.savepoint():
+                    tx = txs_by_stamp.get(data.get("checkout-stamp")) or self.env[
+                        "payment.transaction"
+                    ]._get_tx_from_notification_data("paytrail", data)
+                    if not tx._paytrail_is_notification_merchant(data):
+                        # Not retried, the merchant does not change
+                        _logger.warning(
+                            "Notification for tx %s sent by another merchant",
+                            tx.reference,
+                        )
+                        notification.error = "Sent by another merchant account"
+                        continue
+                    if not tx._paytrail_is_notification_processed(data):
+                        tx._handle_notification_data("paytrail", data)
+                        tx._paytrail_set_notification_processed(data)
+            except Exception as e:
+                notification._set_failed(str(e) or type(e).__name__)
+                continue
+            processed |= notification
+        processed.unlink()
+
+    def _set_failed(self, error):
+        """
+        Schedule a failed notification to be processed again, with exponential
+        backoff. Paytrail does not send the callback again, as it has been
+        answered. Once all attempts have failed, the notification is kept with
+        its error.
+
+        :param error: string
+        :return: None
+        """
+        self.ensure_one()
+        attempts = self.attempts + 1
+        if attempts >= const.NOTIFICATION_MAX_ATTEMPTS:
+            _logger.warning(
+                "Could not process Paytrail notification %s, giving up: %s",
+                self.id,
+                error,
+            )
+            self.write({"attempts": attempts, "error": error})
+            return
+
+        delay = const.NOTIFICATION_RETRY_DELAY * 2 ** (attempts - 1)
+        _logger.info(
+            "Could not process Paytrail notification %s, retrying in %s s: %s",
+            self.id,
+            delay,
+            error,
+        )
+        self.write(
+            {
+                "attempts": attempts,
+                "next_attempt": fields.Datetime.now() + timedelta(seconds=delay),
+            }
+        )
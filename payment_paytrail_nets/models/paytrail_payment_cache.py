@@ -0,0 +1,127 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_paytrail_nets import const
+
+
+class PaytrailPaymentCache(models.Model):
+    _name = "paytrail.payment.cache"
+    _description = "Paytrail payment cache"
+
+    provider_id = fields.Many2one(
+        comodel_name="payment.provider",
+        required=True,
+        ondelete="cascade",
+    )
+    transaction_id = fields.Many2one(
+        comodel_name="payment.transaction",
+        ondelete="cascade",
+    )
+    payload_hash = fields.Char(required=True, index=True)
+    reference = fields.Char(index=True)
+    stamp = fields.Char(required=True)
+    paytrail_transaction_id = fields.Char(string="Paytrail transaction ID")
+    response = fields.Text(required=True)
+    expiry = fields.Datetime(required=True, index=True)
+
+    @api.model
+    def _get_payload_hash(self, transaction, payload):
+        """
+        Get the hash of the payment payload of a transaction. The stamp and the
+        reference are left out, as each payment attempt of an order gets new
+        ones, and the orders or invoices of the transaction are added. Payloads
+        with the same hash create identical payments.
+
+        :param transaction: payment.transaction, saved or not
+        :param payload: JSON bytes
+        :return: string
+        """
+        content = json.loads(payload)
+        content.pop("stamp", None)
+        content.pop("reference", None)
+        for item in content.get("items", []):
+            # Shop-in-Shop items have their own stamp and reference
+            item.pop("stamp", None)
+            item.pop("reference", None)
+        content["saleOrderIds"] = transaction.sale_order_ids.ids
+        content["invoiceIds"] = transaction.invoice_ids.ids
+        return hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    @api.model
+    def _get_cached_payment(self, provider, payload_hash):
+        """
+        Get a still valid payment created with an identical payload, for a
+        transaction that has not been paid
+
+        :param provider: payment.provider
+        :param payload_hash: string
+        :return: paytrail.payment.cache
+        """
+        return self.search(
+            [
+                ("provider_id", "=", provider.id),
+                ("payload_hash", "=", payload_hash),
+                ("expiry", ">", fields.Datetime.now()),
+                "|",
+                ("transaction_id", "=", False),
+                ("transaction_id.state", "=", "draft"),
+            ],
+            limit=1,
+        )
+
+    @api.model
+    def _cache_payment(
+        self, provider, payload_hash, stamp, data, transaction=None, reference=None
+    ):
+        """
+        Store a created payment for reuse. Payments created in advance for a
+        reference replace the earlier ones, whose order has since changed.
+
+        :param provider: payment.provider
+        :param payload_hash: string
+        :param stamp: string
+        :param data: dict, response from Paytrail payment creation
+        :param transaction: payment.transaction
+        :param reference: string, reference of the transaction that is not
+            created yet, for payments created in advance
+        :return: paytrail.payment.cache
+        """
+        if reference:
+            self.search(
+                [
+                    ("provider_id", "=", provider.id),
+                    ("reference", "=", reference),
+                    ("transaction_id", "=", False),
+                ]
+            ).unlink()
+        return self.create(
+            {
+                "provider_id": provider.id,
+                "transaction_id": transaction and transaction.id,
+                "reference": reference or (transaction and transaction.reference),
+                "payload_hash": payload_hash,
+                "stamp": stamp,
+                "paytrail_transaction_id": data.get("transactionId"),
+                "response": json.dumps(data),
+                "expiry": fields.Datetime.now()
+                + timedelta(minutes=const.PAYMENT_CACHE_TTL_MINUTES),
+            }
+        )
+
+    def _get_response(self):
+        """
+        Get the cached response from Paytrail payment creation
+
+        :return: dict
+        """
+        self.ensure_one()
+        return json.loads(self.response)
+
+    @api.autovacuum
+    def _gc_expired_payments(self):
+        self.search([("expiry", "<=", fields.Datetime.now())]).unlink()
@@ -0,0 +1,303 @@
+import logging
+from decimal import Decimal, InvalidOperation
+
+from odoo import _, api, fields, models
+from odoo.tools import SQL
+
+from odoo.addons.payment_paytrail_nets import const
+
+_logger = logging.getLogger(__name__)
+
+
+class PaytrailSettlement(models.Model):
+    _name = "paytrail.settlement"
+    _description = "Paytrail settlement"
+    _order = "id desc"
+
+    name = fields.Char(string="Settlement ID", required=True, readonly=True)
+    provider_id = fields.Many2one(
+        comodel_name="payment.provider",
+        required=True,
+        readonly=True,
+        ondelete="cascade",
+    )
+    settlement_reference = fields.Char(
+        string="Bank reference",
+        readonly=True,
+        index=True,
+        help="Reference of the bank transfer, shown on the bank statement",
+    )
+    line_ids = fields.One2many(
+        comodel_name="paytrail.settlement.line",
+        inverse_name="settlement_id",
+        string="Payments",
+        readonly=True,
+    )
+    unmatched_count = fields.Integer(
+        string="Unmatched payments",
+        compute="_compute_unmatched_count",
+    )
+
+    _sql_constraints = [
+        (
+            "name_provider_uniq",
+            "unique(name, provider_id)",
+            "The settlement has already been imported",
+        )
+    ]
+
+    def _compute_unmatched_count(self):
+        counts = dict(
+            self.env["paytrail.settlement.line"]._read_group(
+                [("settlement_id", "in", self.ids), ("transaction_id", "=", False)],
+                ["settlement_id"],
+                ["__count"],
+            )
+        )
+        for settlement in self:
+            settlement.unmatched_count = counts.get(settlement, 0)
+
+    @api.model
+    def _import_settlements(self, provider, settlements):
+        """
+        Import settlements and their payments. Settlements are consumed one by
+        one, and their payments are matched to transactions and created in
+        batches.
+
+        :param provider: payment.provider
+        :param settlements: iterable of settlement dicts from Paytrail API
+        :return: paytrail.settlement, the imported settlements
+        """
+        existing_names = set(
+            self.search([("provider_id", "=", provider.id)]).mapped("name")
+        )
+        line_model = self.env["paytrail.settlement.line"]
+
+        imported_ids = []
+        pending_lines = []
+        for settlement_data in settlements:
+            if settlement_data["id"] in existing_names:
+                continue
+            settlement = self.create(
+                {
+                    "name": settlement_data["id"],
+                    "provider_id": provider.id,
+                    "settlement_reference": settlement_data.get("settlementReference"),
+                }
+            )
+            imported_ids.append(settlement.id)
+            for paytrail_transaction_id in settlement_data.get("transactionIds", []):
+                pending_lines.append((settlement.id, paytrail_transaction_id))
+                if len(pending_lines) >= const.SETTLEMENT_BATCH_SIZE:
+                    line_model._create_matched(provider, pending_lines)
+                    pending_lines = []
+        if pending_lines:
+            line_model._create_matched(provider, pending_lines)
+
+        _logger.info(
+            "Imported %s Paytrail settlements of %s", len(imported_ids), provider.name
+        )
+        return self.browse(imported_ids)
+
+    @api.model
+    def _import_payment_report(self, provider, rows):
+        """
+        Import a payment report, adding the amount and status of each payment
+        to the settled payments. Rows are consumed and written in batches.
+
+        :param provider: payment.provider
+        :param rows: iterable of dicts, rows of the report
+        :return: int, the number of updated payments
+        """
+        line_model = self.env["paytrail.settlement.line"]
+        updated = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= const.SETTLEMENT_BATCH_SIZE:
+                updated += line_model._update_from_report(provider, batch)
+                batch = []
+        if batch:
+            updated += line_model._update_from_report(provider, batch)
+
+        _logger.info(
+            "Updated %s settled Paytrail payments of %s from report",
+            updated,
+            provider.name,
+        )
+        return updated
+
+    def action_view_lines(self):
+        """
+        Show the payments of the settlement
+
+        :return: dict, action
+        """
+        self.ensure_one()
+        return {
+            "type": "ir.actions.act_window",
+            "name": _("Settled payments"),
+            "res_model": "paytrail.settlement.line",
+            "view_mode": "tree",
+            "domain": [("settlement_id", "=", self.id)],
+        }
+
+
+class PaytrailSettlementLine(models.Model):
+    _name = "paytrail.settlement.line"
+    _description = "Paytrail settled payment"
+    _order = "id"
+    _log_access = False
+
+    settlement_id = fields.Many2one(
+        comodel_name="paytrail.settlement",
+        required=True,
+        readonly=True,
+        index=True,
+        ondelete="cascade",
+    )
+    provider_id = fields.Many2one(
+        comodel_name="payment.provider",
+        required=True,
+        readonly=True,
+        ondelete="cascade",
+    )
+    paytrail_transaction_id = fields.Char(
+        string="Paytrail transaction ID",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    transaction_id = fields.Many2one(
+        comodel_name="payment.transaction",
+        readonly=True,
+        index="btree_not_null",
+        ondelete="set null",
+    )
+    stamp = fields.Char(readonly=True)
+    status = fields.Char(readonly=True)
+    amount = fields.Float(readonly=True)
+
+    @api.model
+    def _create_matched(self, provider, lines):
+        """
+        Create settled payments, matched to transactions by the Paytrail
+        transaction ID with one query
+
+        :param provider: payment.provider
+        :param lines: list of (settlement id, Paytrail transaction id) tuples
+        :return: None
+        """
+        paytrail_ids = [paytrail_id for _settlement_id, paytrail_id in lines]
+        tx_index = {
+            tx.provider_reference: tx.id
+            for tx in self.env["payment.transaction"].search_fetch(
+                [
+                    ("provider_id", "=", provider.id),
+                    ("provider_reference", "in", paytrail_ids),
+                ],
+                ["provider_reference"],
+            )
+        }
+        self.create(
+            [
+                {
+                    "settlement_id": settlement_id,
+                    "provider_id": provider.id,
+                    "paytrail_transaction_id": paytrail_id,
+                    "transaction_id": tx_index.get(paytrail_id),
+                }
+                for settlement_id, paytrail_id in lines
+            ]
+        )
+        # Keep memory use flat over large imports
+        self.env.invalidate_all()
+
+    @api.model
+    def _update_from_report(self, provider, rows):
+        """
+        Update settled payments from rows of a payment report. Payments that
+        were not matched by the Paytrail transaction ID are matched by stamp.
+
+        :param provider: payment.provider
+        :param rows: list of dicts, rows of the report
+        :return: int, the number of updated payments
+        """
+        rows = [row for row in rows if row.get("transactionId")]
+        if not rows:
+            return 0
+
+        stamps = [row["stamp"] for row in rows if row.get("stamp")]
+        tx_index = {
+            tx.paytrail_checkout_stamp: tx.id
+            for tx in self.env["payment.transaction"].search_fetch(
+                [
+                    ("provider_id", "=", provider.id),
+                    ("paytrail_checkout_stamp", "in", stamps),
+                ],
+                ["paytrail_checkout_stamp"],
+            )
+        }
+        values = SQL(", ").join(
+            SQL(
+                "(%s, %s, %s, %s::float, %s::integer, %s::integer)",
+                row["transactionId"],
+                row.get("stamp") or None,
+                row.get("status") or None,
+                self._parse_report_amount(row),
+                tx_index.get(row.get("stamp")),
+                provider.id,
+            )
+            for row in rows
+        )
+
+        # Hundreds of thousands of rows, so update them in one query per batch.
+        # Amounts that could not be parsed are left as they are.
+        self.flush_model()
+        self.env.cr.execute(
+            SQL(
+                """
+                UPDATE paytrail_settlement_line AS line
+                   SET stamp = v.stamp,
+                       status = v.status,
+                       amount = COALESCE(v.amount, line.amount),
+                       transaction_id = COALESCE(line.transaction_id, v.transaction_id)
+                  FROM (VALUES %s) AS v(
+                           paytrail_transaction_id,
+                           stamp,
+                           status,
+                           amount,
+                           transaction_id,
+                           provider_id
+                       )
+                 WHERE line.paytrail_transaction_id = v.paytrail_transaction_id
+                   AND line.provider_id = v.provider_id
+                """,
+                values,
+            )
+        )
+        self.invalidate_model()
+        return self.env.cr.rowcount
+
+    @api.model
+    def _parse_report_amount(self, row):
+        """
+        Parse the amount of a payment report row. Amounts are in cents, unless
+        they have decimals, e.g. "12.50", in which case they are in euros.
+
+        :param row: dict, row of the report
+        :return: Decimal, in euros, or None if the amount cannot be parsed
+        """
+        amount = str(row.get("amount") or "").strip().replace(",", ".")
+        try:
+            value = Decimal(amount)
+        except InvalidOperation:
+            value = None
+        if value is None or not value.is_finite():
+            _logger.warning(
+                "Invalid amount %r of Paytrail payment %s in report",
+                row.get("amount"),
+                row.get("transactionId"),
+            )
+            return None
+        return value if "." in amount else value / 100
@@ -0,0 +1,15 @@
+from odoo import fields, models
+
+
+class ProductTemplate(models.Model):
+    _inherit = "product.template"
+
+    paytrail_sub_merchant_id = fields.Char(
+        string="Paytrail Sub-merchant ID",
+        help="Paytrail Shop-in-Shop sub-merchant that is paid for this product",
+    )
+    paytrail_commission_percent = fields.Float(
+        string="Paytrail Commission (%)",
+        help="Share of the price the Shop-in-Shop aggregate merchant takes as "
+        "commission",
+    )
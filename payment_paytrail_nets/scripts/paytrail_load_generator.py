@@ -0,0 +1,190 @@
+"""
+Load generator replaying signed Paytrail callbacks to Odoo.
+
+Sends success and cancel callbacks, signed with the merchant secret, at a
+fixed rate and reports the response times and statuses. Callbacks are made
+for the transactions of a CSV file with columns ``reference``, ``stamp``,
+``transaction_id`` and ``amount`` (in cents). Without a file, callbacks are
+made for random transactions, which measures how fast unknown transactions
+are rejected.
+
+Only the standard library is used, so the generator runs without Odoo:
+
+    python3 paytrail_load_generator.py http://localhost:8069 --rate 50 \\
+        --duration 60 --transactions transactions.csv
+"""
+
+import argparse
+import csv
+import hashlib
+import hmac
+import itertools
+import logging
+import random
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import HTTPRedirectHandler, build_opener
+
+_logger = logging.getLogger("paytrail_load_generator")
+
+MERCHANT_ID = "375917"
+MERCHANT_SECRET = "SAIPPUAKAUPPIAS"
+
+SUCCESS_PATH = "/payment/paytrail/success"
+CANCEL_PATH = "/payment/paytrail/cancel"
+CALLBACK_PATH = "/payment/paytrail/callback"
+
+
+class NoRedirectHandler(HTTPRedirectHandler):
+    """Keep redirects as responses, as the status page is not part of the load"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def compute_signature(secret, params):
+    """
+    Compute Paytrail HMAC signature of the checkout- parameters of a callback
+
+    :param secret: string
+    :param params: dict
+    :return: string
+    """
+    mac = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+    for key in sorted(key for key in params if key.startswith("checkout-")):
+        mac.update(f"{key}:{params[key]}\n".encode("utf-8"))
+    return mac.hexdigest()
+
+
+def read_transactions(path):
+    """
+    Read the transactions to send callbacks for
+
+    :param path: string, CSV file, or None for random transactions
+    :return: list of dicts
+    """
+    if not path:
+        return [
+            {
+                "reference": f"LOAD-{index}",
+                "stamp": str(uuid.uuid4()),
+                "transaction_id": str(uuid.uuid4()),
+                "amount": "1000",
+            }
+            for index in range(1000)
+        ]
+    with open(path, newline="", encoding="utf-8") as transactions_file:
+        return list(csv.DictReader(transactions_file))
+
+
+def build_callback(transaction, status, merchant_id, secret):
+    """
+    Build the signed parameters of a callback
+
+    :param transaction: dict
+    :param status: string, "ok" or "fail"
+    :param merchant_id: string
+    :param secret: string
+    :return: dict
+    """
+    params = {
+        "checkout-account": merchant_id,
+        "checkout-algorithm": "sha256",
+        "checkout-amount": transaction["amount"],
+        "checkout-stamp": transaction["stamp"],
+        "checkout-reference": transaction["reference"],
+        "checkout-transaction-id": transaction["transaction_id"],
+        "checkout-status": status,
+        "checkout-provider": "nordea",
+    }
+    params["signature"] = compute_signature(secret, params)
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("url", help="Base URL of Odoo, e.g. http://localhost:8069")
+    parser.add_argument("--rate", type=float, default=10, help="Callbacks per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run")
+    parser.add_argument(
+        "--cancel-ratio", type=float, default=0.1, help="Share of cancel callbacks"
+    )
+    parser.add_argument(
+        "--queued",
+        action="store_true",
+        help="Send to the queued callback route instead of the return routes",
+    )
+    parser.add_argument("--transactions", help="CSV file of transactions")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--merchant-id", default=MERCHANT_ID)
+    parser.add_argument("--secret", default=MERCHANT_SECRET)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    transactions = read_transactions(args.transactions)
+    opener = build_opener(NoRedirectHandler)
+    durations = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def send(transaction):
+        cancel = random.random() < args.cancel_ratio
+        params = build_callback(
+            transaction, "fail" if cancel else "ok", args.merchant_id, args.secret
+        )
+        if args.queued:
+            path = CALLBACK_PATH
+        else:
+            path = CANCEL_PATH if cancel else SUCCESS_PATH
+        url = f"{args.url.rstrip('/')}{path}?{urlencode(params)}"
+
+        start = time.perf_counter()
+        try:
+            with opener.open(url, timeout=args.timeout) as response:
+                status = response.status
+        except HTTPError as e:
+            status = e.code
+        except (URLError, OSError) as e:
+            status = type(e).__name__
+        duration = time.perf_counter() - start
+        with lock:
+            durations.append(duration)
+            statuses[status] += 1
+
+    interval = 1 / args.rate
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for index, transaction in enumerate(itertools.cycle(transactions)):
+            send_at = start + index * interval
+            if send_at - start >= args.duration:
+                break
+            delay = send_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, transaction)
+    elapsed = time.monotonic() - start
+
+    _logger.info("Sent %s callbacks in %.1f s", len(durations), elapsed)
+    _logger.info("Throughput: %.1f callbacks per second", len(durations) / elapsed)
+    if len(durations) > 1:
+        quantiles = statistics.quantiles(durations, n=100, method="inclusive")
+        _logger.info(
+            "Response time: median %.0f ms, p95 %.0f ms, p99 %.0f ms, max %.0f ms",
+            quantiles[49] * 1000,
+            quantiles[94] * 1000,
+            quantiles[98] * 1000,
+            max(durations) * 1000,
+        )
+    for status, count in sorted(statuses.items(), key=str):
+        _logger.info("Status %s: %s", status, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+Local mock of Paytrail API for load testing.
+
+Fakes payment creation and status, payment providers, token charges, refunds
+and settlements. Requests are checked and responses are signed with the test
+merchant credentials, like services.paytrail.com does. Latency and errors can
+be added to simulate a slow or failing Paytrail.
+
+Only the standard library is used, so the mock runs without Odoo:
+
+    python3 paytrail_mock_server.py --port 8089 --latency 0.2 --error-rate 0.01
+
+Point the module to the mock with the system parameter
+``payment_paytrail_nets.api_url``, e.g. ``http://localhost:8089``.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+_logger = logging.getLogger("paytrail_mock_server")
+
+MERCHANT_ID = "375917"
+MERCHANT_SECRET = "SAIPPUAKAUPPIAS"
+
+LOGO_URL = "https://resources.paytrail.com/images/payment-method-logos"
+
+PAYMENT_PROVIDERS = [
+    {
+        "id": provider_id,
+        "name": name,
+        "group": group,
+        "icon": f"{LOGO_URL}/{logo}.png",
+        "svg": f"{LOGO_URL}/{logo}.svg",
+    }
+    for provider_id, name, group, logo in [
+        ("nordea", "Nordea", "bank", "nordea"),
+        ("osuuspankki", "OP", "bank", "op"),
+        ("mobilepay", "MobilePay", "mobile", "mobilepay"),
+        ("creditcard", "Visa", "creditcard", "visa"),
+    ]
+]
+
+
+def compute_signature(secret, headers, body):
+    """
+    Compute Paytrail HMAC signature of the checkout- headers and body
+
+    :param secret: string
+    :param headers: dict, lower-case header names
+    :param body: bytes
+    :return: string
+    """
+    mac = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+    for key in sorted(key for key in headers if key.startswith("checkout-")):
+        mac.update(f"{key}:{headers[key]}\n".encode("utf-8"))
+    mac.update(body)
+    return mac.hexdigest()
+
+
+class PaytrailMock:
+    """State and configuration of the mock, shared by the request handlers"""
+
+    def __init__(self, base_url, latency, jitter, error_rate, payment_status):
+        self.base_url = base_url
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payment_status = payment_status
+        self.payments = {}
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """Sleep for the configured latency"""
+        latency = self.latency + random.uniform(-self.jitter, self.jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    def create_payment(self, data, status="new"):
+        """
+        Store a new payment
+
+        :param data: dict, request payload
+        :param status: string, initial status of the payment
+        :return: dict, the stored payment
+        """
+        transaction_id = str(uuid.uuid4())
+        payment = {
+            "id": transaction_id,
+            "status": status,
+            "amount": data.get("amount", 0),
+            "currency": data.get("currency", "EUR"),
+            "stamp": data.get("stamp"),
+            "reference": data.get("reference"),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "provider": "nordea",
+        }
+        with self.lock:
+            self.payments[transaction_id] = payment
+        return payment
+
+    def get_payment(self, transaction_id):
+        """
+        Get a stored payment. Payments that are still new get the configured
+        status, as if the customer had paid them.
+
+        :param transaction_id: string
+        :return: dict, or None
+        """
+        with self.lock:
+            payment = self.payments.get(transaction_id)
+            if payment and payment["status"] == "new" and self.payment_status:
+                payment["status"] = self.payment_status
+        return payment
+
+
+class PaytrailMockHandler(BaseHTTPRequestHandler):
+    """Handles requests to the mock as Paytrail API would"""
+
+    server_version = "PaytrailMock/1.0"
+    protocol_version = "HTTP/1.1"
+
+    routes = [
+        ("POST", r"/payments", "payments_create"),
+        ("GET", r"/payments/(?P<transaction_id>[\w-]+)", "payments_get"),
+        ("POST", r"/payments/(?P<transaction_id>[\w-]+)/refund", "refund"),
+        ("POST", r"/payments/(?P<transaction_id>[\w-]+)/refund/email", "refund"),
+        ("POST", r"/payments/token/(?:cit|mit)/charge", "token_charge"),
+        ("POST", r"/payments/report", "payment_report"),
+        ("GET", r"/merchants/payment-providers", "payment_providers"),
+        ("POST", r"/tokenization/(?P<tokenization_id>[\w-]+)", "tokenization"),
+        ("GET", r"/settlements", "settlements"),
+    ]
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        _logger.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def _dispatch(self, method):
+        path = urlsplit(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        self.mock.delay()
+        if random.random() < self.mock.error_rate:
+            self._respond(503, {"status": "error", "message": "Mock failure"})
+            return
+
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        if headers.get("checkout-account") != MERCHANT_ID or not hmac.compare_digest(
+            headers.get("signature", ""),
+            compute_signature(MERCHANT_SECRET, headers, body),
+        ):
+            self._respond(401, {"status": "error", "message": "Invalid signature"})
+            return
+
+        for route_method, pattern, handler_name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                try:
+                    data = json.loads(body) if body else {}
+                except ValueError:
+                    self._respond(400, {"status": "error", "message": "Invalid JSON"})
+                    return
+                status, content = getattr(self, handler_name)(data, **match.groupdict())
+                self._respond(status, content)
+                return
+
+        self._respond(404, {"status": "error", "message": "Not found"})
+
+    def _respond(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        headers = {
+            "checkout-account": MERCHANT_ID,
+            "checkout-algorithm": "sha256",
+            "checkout-nonce": uuid.uuid4().hex,
+            "checkout-timestamp": datetime.now(timezone.utc).isoformat(),
+        }
+        if isinstance(content, dict) and content.get("transactionId"):
+            headers["checkout-transaction-id"] = content["transactionId"]
+        headers["signature"] = compute_signature(MERCHANT_SECRET, headers, body)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def payments_create(self, data):
+        payment = self.mock.create_payment(data)
+        transaction_id = payment["id"]
+        return 201, {
+            "transactionId": transaction_id,
+            "href": f"{self.mock.base_url}/pay/{transaction_id}",
+            "reference": payment["reference"],
+            "terms": "https://www.paytrail.com/kuluttaja/maksupalveluehdot",
+            "groups": [],
+            "providers": [
+                {
+                    "url": f"{self.mock.base_url}/pay/{transaction_id}/{p['id']}",
+                    "icon": p["icon"],
+                    "svg": p["svg"],
+                    "group": p["group"],
+                    "name": p["name"],
+                    "id": p["id"],
+                    "parameters": [{"name": "transactionId", "value": transaction_id}],
+                }
+                for p in PAYMENT_PROVIDERS
+            ],
+        }
+
+    def payments_get(self, data, transaction_id):
+        payment = self.mock.get_payment(transaction_id)
+        if not payment:
+            return 404, {"status": "error", "message": "Payment not found"}
+        return 200, payment
+
+    def refund(self, data, transaction_id):
+        if not self.mock.get_payment(transaction_id):
+            return 404, {"status": "error", "message": "Payment not found"}
+        return 201, {
+            "transactionId": str(uuid.uuid4()),
+            "status": "ok",
+            "provider": "nordea",
+        }
+
+    def token_charge(self, data):
+        if not data.get("token"):
+            return 400, {"status": "error", "message": "Missing token"}
+        payment = self.mock.create_payment(data, status="ok")
+        return 201, {"transactionId": payment["id"]}
+
+    def payment_report(self, data):
+        return 200, {"requestId": str(uuid.uuid4())}
+
+    def payment_providers(self, data):
+        return 200, PAYMENT_PROVIDERS
+
+    def tokenization(self, data, tokenization_id):
+        return 200, {
+            "token": f"mock-token-{tokenization_id}",
+            "card": {
+                "type": "Visa",
+                "bin": "415301",
+                "partial_pan": "0024",
+                "expire_year": "2030",
+                "expire_month": "11",
+                "cvc_required": "no",
+                "funding": "credit",
+                "category": "unknown",
+                "country_code": "FI",
+                "pan_fingerprint": "mock",
+                "card_fingerprint": "mock",
+            },
+        }
+
+    def settlements(self, data):
+        with self.mock.lock:
+            transaction_ids = [
+                payment["id"]
+                for payment in self.mock.payments.values()
+                if payment["status"] == "ok"
+            ]
+        if not transaction_ids:
+            return 200, []
+        return 200, [
+            {
+                "id": str(uuid.uuid4()),
+                "settlementReference": "1232",
+                "transactionIds": transaction_ids,
+            }
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds added to each response"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0, help="Random variation of the latency"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="Share of requests answered with 503, between 0 and 1",
+    )
+    parser.add_argument(
+        "--payment-status",
+        default="ok",
+        choices=["new", "ok", "fail", "pending"],
+        help="Status of created payments when their status is queried",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    server = ThreadingHTTPServer((args.host, args.port), PaytrailMockHandler)
+    server.daemon_threads = True
+    server.mock = PaytrailMock(
+        f"http://{args.host}:{args.port}",
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.payment_status,
+    )
+    _logger.info("Paytrail mock listening on http://%s:%s", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+/** @odoo-module **/
+
+import paymentForm from "@payment/js/payment_form";
+import { jsonrpc } from "@web/core/network/rpc_service";
+
+paymentForm.include({
+    /**
+     * Ask the server to create the Paytrail payment of the cart in advance, so
+     * that the customer is sent to Paytrail right away when they click Pay.
+     *
+     * @override method from @payment/js/payment_form
+     */
+    async start() {
+        await this._super(...arguments);
+        if (!this.paymentContext.transactionRoute?.startsWith("/shop/payment")) {
+            return;
+        }
+        // Payment methods of a provider share its payment, so it is created once
+        const providerIds = new Set();
+        this.el
+            .querySelectorAll(
+                'input[name="o_payment_radio"][data-provider-code="paytrail"][data-paytrail-precreate]'
+            )
+            .forEach((radio) => providerIds.add(parseInt(radio.dataset.providerId)));
+        providerIds.forEach((providerId) => {
+            // Failures are not shown, the payment is then created on click
+            const params = {provider_id: providerId};
+            jsonrpc("/payment/paytrail/precreate", params).catch(() => {});
+        });
+    },
+
+    /**
+     * Show the bank and wallet buttons of a Paytrail payment, when available,
+     * instead of redirecting to the Paytrail payment page.
+     *
+     * @override method from @payment/js/payment_form
+     * @private
+     * @param {string} providerCode - The code of the selected payment option's provider.
+     * @param {number} paymentOptionId - The id of the selected payment option.
+     * @param {string} paymentMethodCode - The code of the selected payment method, if any.
+     * @param {object} processingValues - The processing values of the transaction.
+     * @return {void}
+     */
+    _processRedirectFlow(providerCode, paymentOptionId, paymentMethodCode, processingValues) {
+        if (providerCode !== "paytrail") {
+            return this._super(...arguments);
+        }
+        const container = document.createElement("div");
+        container.innerHTML = processingValues.redirect_form_html;
+        const providers = container.querySelector(".o_paytrail_providers");
+        if (!providers) {
+            return this._super(...arguments);
+        }
+        providers.querySelectorAll("form").forEach((form) => {
+            form.setAttribute("target", "_top");
+        });
+        this.el.classList.add("d-none");
+        this.el.after(providers);
+        this._enableButton();
+    },
+
+    /**
+     * Redirect to 3D Secure authentication when a Paytrail token payment
+     * requires it.
+     *
+     * @override method from @payment/js/payment_form
+     * @private
+     * @param {string} providerCode - The code of the selected payment option's provider.
+     * @param {number} paymentOptionId - The id of the selected payment option.
+     * @param {string} paymentMethodCode - The code of the selected payment method, if any.
+     * @param {object} processingValues - The processing values of the transaction.
+     * @return {void}
+     */
+    _processTokenFlow(providerCode, paymentOptionId, paymentMethodCode, processingValues) {
+        if (providerCode === "paytrail" && processingValues.paytrail_3ds_url) {
+            window.location = processingValues.paytrail_3ds_url;
+            return;
+        }
+        return this._super(...arguments);
+    },
+});
@@ -0,0 +1,8 @@
+from . import test_paytrail_benchmark
+from . import test_paytrail_notification
+from . import test_paytrail_reconcile
+from . import test_paytrail_refund
+from . import test_paytrail_settlement
+from . import test_paytrail_token_charge
+from . import test_paytrail_tokenization
+from . import test_paytrail_utils
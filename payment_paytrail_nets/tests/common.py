@@ -0,0 +1,109 @@
+import json
+from unittest.mock import patch
+from urllib.parse import urlsplit
+
+from odoo import Command
+
+from odoo.addons.payment.tests.http_common import PaymentHttpCommon
+
+
+class MockResponse:
+    """Response of the local Paytrail mock"""
+
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self._data = data
+        self.headers = {}
+        self.content = json.dumps(data).encode("utf-8")
+        self.text = str(data)
+
+    def json(self):
+        return self._data
+
+
+class PaytrailCommon(PaymentHttpCommon):
+    """Paytrail test provider, and a mock that replaces Paytrail API"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.paytrail = cls._prepare_provider(
+            "paytrail",
+            update_values={
+                "paytrail_merchant_id": "375917",
+                "paytrail_merchant_secret": "SAIPPUAKAUPPIAS",
+            },
+        )
+        cls.provider = cls.paytrail
+        cls.currency = cls.currency_euro
+        cls.payment_method_id = cls.env.ref("payment.payment_method_paytrail").id
+        cls.partner.write(
+            {
+                "email": "norbert.buyer@example.com",
+                "street": "Testikatu 1",
+                "zip": "33100",
+                "city": "Tampere",
+                "country_id": cls.env.ref("base.fi").id,
+            }
+        )
+
+    def _create_order(self):
+        """
+        Create a sale order to pay
+
+        :return: sale.order
+        """
+        if "sale.order" not in self.env:
+            self.skipTest("Sale is not installed")
+
+        product = self.env["product.product"].create(
+            {"name": "Paytrail test product", "list_price": 12.5}
+        )
+        return self.env["sale.order"].create(
+            {
+                "partner_id": self.partner.id,
+                "order_line": [
+                    Command.create({"product_id": product.id, "product_uom_qty": 2})
+                ],
+            }
+        )
+
+    def _signed_response(self, status_code, data):
+        """
+        Get a response signed with the merchant secret, like responses of
+        Paytrail API
+
+        :param status_code: int
+        :param data: dict
+        :return: MockResponse
+        """
+        response = MockResponse(status_code, data)
+        response.headers = {
+            "checkout-account": self.paytrail.paytrail_merchant_id,
+            "checkout-algorithm": "sha256",
+        }
+        response.headers["signature"] = self.paytrail._paytrail_compute_signature(
+            response.headers, response.content
+        )
+        return response
+
+    def _mock_paytrail(self, handler):
+        """
+        Replace Paytrail API with a local handler. The requests sent are
+        recorded in self.paytrail_requests as (method, path, payload) tuples.
+
+        :param handler: function of the method, path and payload of a request
+            that returns a MockResponse
+        :return: context manager
+        """
+        self.paytrail_requests = []
+
+        def send_request(merchant_id, method, url, headers, data=None, **kwargs):
+            path = urlsplit(url).path
+            payload = json.loads(data) if data else {}
+            self.paytrail_requests.append((method, path, payload))
+            return handler(method, path, payload)
+
+        return patch(
+            "odoo.addons.payment_paytrail_nets.utils.send_request", send_request
+        )
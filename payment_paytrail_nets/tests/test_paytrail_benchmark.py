@@ -0,0 +1,197 @@
+import hashlib
+import hmac
+import logging
+import time
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+from odoo import Command
+from odoo.tests import tagged
+
+from odoo.addons.payment_paytrail_nets.controllers.main import PaytrailController
+from odoo.addons.payment_paytrail_nets.tests.common import (
+    MockResponse,
+    PaytrailCommon,
+)
+
+_logger = logging.getLogger(__name__)
+
+PAYTRAIL_PAYMENT_RESPONSE = {
+    "transactionId": "5770642a-9a02-4ca2-8eaa-cc6260a78eb6",
+    "href": "https://pay.paytrail.com/pay/5770642a-9a02-4ca2-8eaa-cc6260a78eb6",
+    "reference": "809759248",
+    "terms": "https://www.paytrail.com/kuluttaja/maksupalveluehdot",
+    "groups": [],
+    "providers": [],
+}
+
+
+def mock_send_request(merchant_id, method, url, headers, data=None, **kwargs):
+    """Local mock of services.paytrail.com"""
+    if url.endswith("/payments") and method == "POST":
+        return MockResponse(201, PAYTRAIL_PAYMENT_RESPONSE)
+    return MockResponse(404, {"status": "error", "message": "Not found"})
+
+
+@tagged("post_install", "-at_install", "paytrail_benchmark")
+class TestPaytrailBenchmark(PaytrailCommon):
+    """Benchmarks of the checkout and callback hot paths.
+
+    Timings are logged for comparison between versions. Query counts are
+    asserted, so that queries growing with the number of order lines are caught.
+    Paytrail API is replaced with a local mock. Run only these with
+    ``--test-tags paytrail_benchmark``. Payload benchmarks need sale, which is
+    installed in the "test with Odoo and sale" CI job.
+    """
+
+    def _create_order_transaction(self, line_count):
+        if "sale.order" not in self.env:
+            self.skipTest("Sale is not installed")
+
+        product = self.env["product.product"].create(
+            {"name": "Paytrail benchmark product", "list_price": 12.5}
+        )
+        order = self.env["sale.order"].create(
+            {
+                "partner_id": self.partner.id,
+                "order_line": [
+                    Command.create({"product_id": product.id, "product_uom_qty": 2})
+                    for _i in range(line_count)
+                ],
+            }
+        )
+        return self._create_transaction(
+            "redirect",
+            reference=f"paytrail-benchmark-{line_count}",
+            amount=order.amount_total,
+            sale_order_ids=[Command.set(order.ids)],
+        )
+
+    def _measure(self, func, *args):
+        """
+        Run a function with an empty cache
+
+        :return: tuple of result, duration in milliseconds and query count
+        """
+        self.env.flush_all()
+        self.env.invalidate_all()
+        queries_before = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        res = func(*args)
+        self.env.flush_all()
+        duration = (time.perf_counter() - start) * 1000
+        return res, duration, self.env.cr.sql_log_count - queries_before
+
+    def test_form_payment_json(self):
+        query_counts = {}
+        for line_count in (1, 100, 1000):
+            tx = self._create_order_transaction(line_count)
+            values = {"reference": tx.reference, "billing_partner": self.partner}
+            payload, duration, query_count = self._measure(
+                tx._form_paytrail_payment_json, values
+            )
+            self.assertTrue(payload)
+            _logger.info(
+                "Paytrail benchmark: payload of %s lines in %.1f ms, %s queries",
+                line_count,
+                duration,
+                query_count,
+            )
+            query_counts[line_count] = query_count
+
+        self.assertEqual(
+            query_counts[1],
+            query_counts[1000],
+            "Number of queries should not depend on the number of order lines",
+        )
+
+    def test_compute_signature(self):
+        headers = {
+            "checkout-account": "375917",
+            "checkout-algorithm": "sha256",
+            "checkout-method": "POST",
+            "checkout-nonce": "564635208570151",
+            "checkout-timestamp": "2018-07-06T10:01:31.904Z",
+        }
+        payload = b'{"stamp":"benchmark","amount":1525,"currency":"EUR"}'
+
+        expected = hmac.new(
+            b"SAIPPUAKAUPPIAS",
+            b"".join(f"{k}:{headers[k]}\n".encode() for k in sorted(headers)) + payload,
+            hashlib.sha256,
+        ).hexdigest()
+        self.assertEqual(
+            self.paytrail._paytrail_compute_signature(headers, payload), expected
+        )
+
+        iterations = 10000
+        start = time.perf_counter()
+        for _i in range(iterations):
+            self.paytrail._paytrail_compute_signature(headers, payload)
+        duration = time.perf_counter() - start
+        _logger.info(
+            "Paytrail benchmark: %.0f signatures per second", iterations / duration
+        )
+
+    def test_checkout_rendering(self):
+        tx = self._create_order_transaction(100)
+        with patch(
+            "odoo.addons.payment_paytrail_nets.utils.send_request", mock_send_request
+        ):
+            values, duration, query_count = self._measure(
+                tx._get_specific_rendering_values, {"reference": tx.reference}
+            )
+        self.assertEqual(
+            tx.provider_reference, PAYTRAIL_PAYMENT_RESPONSE["transactionId"]
+        )
+        self.assertTrue(values["paytrail_url"])
+        _logger.info(
+            "Paytrail benchmark: checkout rendering in %.1f ms, %s queries",
+            duration,
+            query_count,
+        )
+
+    def _get_callback_data(self, tx, status="ok"):
+        data = {
+            "checkout-account": self.paytrail.paytrail_merchant_id,
+            "checkout-algorithm": "sha256",
+            "checkout-amount": str(int(tx.amount * 100)),
+            "checkout-stamp": tx.paytrail_checkout_stamp,
+            "checkout-reference": tx.reference,
+            "checkout-transaction-id": PAYTRAIL_PAYMENT_RESPONSE["transactionId"],
+            "checkout-status": status,
+            "checkout-provider": "nordea",
+        }
+        data["signature"] = self.paytrail._paytrail_compute_signature(data, "")
+        return data
+
+    def test_return_from_checkout(self):
+        # Callbacks do not depend on the order, so sale is not needed here
+        tx = self._create_transaction(
+            "redirect",
+            reference="paytrail-benchmark-callback",
+            paytrail_checkout_stamp="paytrail-benchmark-stamp",
+        )
+        data = self._get_callback_data(tx)
+        url = f"{self._build_url(PaytrailController._success_url)}?{urlencode(data)}"
+
+        timings = []
+        for _i in range(2):
+            response, duration, query_count = self._measure(
+                lambda: self.url_open(url, allow_redirects=False)
+            )
+            self.assertEqual(response.status_code, 303)
+            timings.append((duration, query_count))
+            _logger.info(
+                "Paytrail benchmark: callback in %.1f ms, %s queries",
+                duration,
+                query_count,
+            )
+
+        tx.invalidate_recordset()
+        self.assertEqual(tx.state, "done")
+        self.assertLessEqual(
+            timings[1][1],
+            timings[0][1],
+            "Duplicate callback should not cost more queries than the first one",
+        )
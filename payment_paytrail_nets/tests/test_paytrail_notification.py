@@ -0,0 +1,96 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.tests import tagged
+
+from odoo.addons.payment_paytrail_nets import const
+from odoo.addons.payment_paytrail_nets.tests.common import PaytrailCommon
+
+
+@tagged("post_install", "-at_install")
+class TestPaytrailNotification(PaytrailCommon):
+    def _enqueue_notification(self, tx):
+        return self.env["paytrail.notification"]._enqueue(
+            {
+                "checkout-account": self.paytrail.paytrail_merchant_id,
+                "checkout-algorithm": "sha256",
+                "checkout-stamp": tx.paytrail_checkout_stamp,
+                "checkout-reference": tx.reference,
+                "checkout-transaction-id": f"{tx.reference}-id",
+                "checkout-status": "ok",
+                "checkout-provider": "nordea",
+            }
+        )
+
+    def _process_notifications(self):
+        self.env["paytrail.notification"]._cron_process_notifications()
+
+    def test_failed_notification_is_retried(self):
+        tx = self._create_transaction(
+            "redirect",
+            reference="paytrail-retry",
+            paytrail_checkout_stamp="paytrail-retry-stamp",
+        )
+        notification = self._enqueue_notification(tx)
+
+        with patch.object(
+            type(tx),
+            "_handle_notification_data",
+            side_effect=ValueError("Concurrent update"),
+        ):
+            self._process_notifications()
+        self.assertTrue(notification.exists())
+        self.assertEqual(notification.attempts, 1)
+        self.assertFalse(notification.error)
+        self.assertGreater(notification.next_attempt, fields.Datetime.now())
+        self.assertEqual(tx.state, "draft")
+
+        # Not processed again before its next attempt
+        self._process_notifications()
+        self.assertTrue(notification.exists())
+        self.assertEqual(tx.state, "draft")
+
+        notification.next_attempt = fields.Datetime.now() - timedelta(seconds=1)
+        self._process_notifications()
+        self.assertFalse(notification.exists())
+        self.assertEqual(tx.state, "done")
+
+    def test_notification_given_up(self):
+        tx = self._create_transaction(
+            "redirect",
+            reference="paytrail-given-up",
+            paytrail_checkout_stamp="paytrail-given-up-stamp",
+        )
+        notification = self._enqueue_notification(tx)
+
+        with patch.object(
+            type(tx),
+            "_handle_notification_data",
+            side_effect=ValueError("Broken"),
+        ):
+            for _i in range(const.NOTIFICATION_MAX_ATTEMPTS):
+                notification.next_attempt = False
+                self._process_notifications()
+
+        self.assertEqual(notification.attempts, const.NOTIFICATION_MAX_ATTEMPTS)
+        self.assertEqual(notification.error, "Broken")
+        self.assertEqual(tx.state, "draft")
+
+    def test_notification_of_another_merchant(self):
+        other_provider = self.paytrail.copy(
+            {"name": "Paytrail other company", "paytrail_merchant_id": "695861"}
+        )
+        tx = self._create_transaction(
+            "redirect",
+            reference="paytrail-other-merchant",
+            provider_id=other_provider.id,
+            paytrail_checkout_stamp="paytrail-other-merchant-stamp",
+        )
+        notification = self._enqueue_notification(tx)
+
+        self._process_notifications()
+
+        self.assertEqual(notification.attempts, 0)
+        self.assertTrue(notification.error)
+        self.assertEqual(tx.state, "draft")
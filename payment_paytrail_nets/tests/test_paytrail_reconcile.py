@@ -0,0 +1,127 @@
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import tagged
+
+from odoo.addons.payment_paytrail_nets import const
+from odoo.addons.payment_paytrail_nets.tests.common import (
+    MockResponse,
+    PaytrailCommon,
+)
+
+
+@tagged("post_install", "-at_install")
+class TestPaytrailReconcile(PaytrailCommon):
+    def _create_stale_transaction(self, reference, provider_reference, age):
+        tx = self._create_transaction(
+            "redirect",
+            reference=reference,
+            provider_reference=provider_reference,
+            paytrail_checkout_stamp=f"{reference}-stamp",
+        )
+        self.env.flush_all()
+        self.env.cr.execute(
+            "UPDATE payment_transaction SET create_date = %s WHERE id = %s",
+            [fields.Datetime.now() - age, tx.id],
+        )
+        tx.invalidate_recordset()
+        return tx
+
+    def _get_payment(self, tx, status):
+        return {
+            "id": tx.provider_reference,
+            "status": status,
+            "amount": 111111,
+            "currency": "EUR",
+            "stamp": tx.paytrail_checkout_stamp,
+            "reference": tx.reference,
+            "provider": "nordea",
+        }
+
+    def test_reconcile_transactions(self):
+        stale = timedelta(minutes=const.RECONCILE_STALE_MINUTES + 1)
+        tx_paid = self._create_stale_transaction("paytrail-paid", "pt-paid", stale)
+        tx_canceled = self._create_stale_transaction(
+            "paytrail-canceled", "pt-canceled", stale
+        )
+        tx_new = self._create_stale_transaction("paytrail-new", "pt-new", stale)
+        tx_unsigned = self._create_stale_transaction(
+            "paytrail-unsigned", "pt-unsigned", stale
+        )
+        tx_recent = self._create_stale_transaction(
+            "paytrail-recent", "pt-recent", timedelta(minutes=1)
+        )
+        tx_abandoned = self._create_stale_transaction(
+            "paytrail-abandoned",
+            "pt-abandoned",
+            timedelta(days=const.RECONCILE_MAX_AGE_DAYS + 1),
+        )
+        # Responses are prepared here, as requests are sent from other threads
+        responses = {
+            f"/payments/{tx.provider_reference}": self._signed_response(
+                200, self._get_payment(tx, status)
+            )
+            for tx, status in [
+                (tx_paid, "ok"),
+                (tx_canceled, "fail"),
+                (tx_new, "new"),
+                (tx_recent, "ok"),
+                (tx_abandoned, "ok"),
+            ]
+        }
+        responses["/payments/pt-unsigned"] = MockResponse(
+            200, self._get_payment(tx_unsigned, "ok")
+        )
+
+        def handler(method, path, payload):
+            return responses.get(path) or MockResponse(404, {"status": "error"})
+
+        with self._mock_paytrail(handler):
+            self.env["payment.transaction"]._cron_paytrail_reconcile_transactions()
+
+        self.assertEqual(
+            sorted(path for _method, path, _payload in self.paytrail_requests),
+            [
+                "/payments/pt-canceled",
+                "/payments/pt-new",
+                "/payments/pt-paid",
+                "/payments/pt-unsigned",
+            ],
+        )
+        self.assertTrue(
+            all(method == "GET" for method, _path, _payload in self.paytrail_requests)
+        )
+        self.assertEqual(tx_paid.state, "done")
+        self.assertEqual(tx_paid.provider_reference, "pt-paid")
+        self.assertEqual(tx_paid.paytrail_checkout_provider, "nordea")
+        self.assertEqual(tx_canceled.state, "cancel")
+        self.assertEqual(tx_new.state, "draft")
+        self.assertEqual(tx_unsigned.state, "draft")
+        self.assertEqual(tx_recent.state, "draft")
+        self.assertEqual(tx_abandoned.state, "draft")
+
+        # Reconciled transactions are not queried again
+        with self._mock_paytrail(handler):
+            self.env["payment.transaction"]._cron_paytrail_reconcile_transactions()
+        self.assertEqual(
+            sorted(path for _method, path, _payload in self.paytrail_requests),
+            ["/payments/pt-new", "/payments/pt-unsigned"],
+        )
+
+    def test_reconcile_skips_failed_queries(self):
+        stale = timedelta(minutes=const.RECONCILE_STALE_MINUTES + 1)
+        tx_error = self._create_stale_transaction("paytrail-error", "pt-error", stale)
+        tx_paid = self._create_stale_transaction("paytrail-paid", "pt-paid", stale)
+        paid_response = self._signed_response(200, self._get_payment(tx_paid, "ok"))
+
+        def handler(method, path, payload):
+            if path == "/payments/pt-error":
+                return MockResponse(500, {"status": "error", "message": "Failure"})
+            return paid_response
+
+        with self._mock_paytrail(handler):
+            (tx_error | tx_paid)._paytrail_reconcile()
+
+        self.assertEqual(tx_error.state, "draft")
+        self.assertEqual(tx_error.provider_reference, "pt-error")
+        self.assertEqual(tx_paid.state, "done")
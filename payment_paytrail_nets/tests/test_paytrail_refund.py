@@ -0,0 +1,236 @@
+from unittest.mock import patch
+
+from odoo.exceptions import UserError
+from odoo.tests import tagged
+
+from odoo.addons.payment_paytrail_nets import utils as paytrail_utils
+from odoo.addons.payment_paytrail_nets.tests.common import (
+    MockResponse,
+    PaytrailCommon,
+)
+
+
+@tagged("post_install", "-at_install")
+class TestPaytrailRefund(PaytrailCommon):
+    def _create_paid_transaction(self, reference, provider_reference, **values):
+        return self._create_transaction(
+            "redirect",
+            reference=reference,
+            state="done",
+            provider_reference=provider_reference,
+            **values,
+        )
+
+    def test_full_refund(self):
+        tx = self._create_paid_transaction("paytrail-full", "pt-full")
+
+        def handler(method, path, payload):
+            return MockResponse(201, {"transactionId": "pt-refund", "status": "ok"})
+
+        with self._mock_paytrail(handler):
+            refund_tx = tx._send_refund_request()
+
+        self.assertEqual(len(self.paytrail_requests), 1)
+        method, path, payload = self.paytrail_requests[0]
+        self.assertEqual((method, path), ("POST", "/payments/pt-full/refund"))
+        self.assertEqual(payload["amount"], 111111)
+        self.assertEqual(payload["refundReference"], refund_tx.reference)
+        self.assertNotIn("items", payload)
+        self.assertEqual(refund_tx.provider_reference, "pt-refund")
+        self.assertEqual(refund_tx.state, "done")
+
+    def test_partial_refund_shop_in_shop(self):
+        self.paytrail.write(
+            {
+                "paytrail_shop_in_shop": True,
+                "paytrail_default_sub_merchant_id": "695874",
+            }
+        )
+        tx = self._create_paid_transaction(
+            "paytrail-sis",
+            "pt-sis",
+            amount=15.25,
+            paytrail_item_amounts={"stamp-0": 1000, "stamp-1": 525},
+        )
+
+        def handler(method, path, payload):
+            return MockResponse(
+                201, {"transactionId": "pt-sis-refund", "status": "pending"}
+            )
+
+        with self._mock_paytrail(handler):
+            with self.assertRaises(UserError):
+                tx._send_refund_request(amount_to_refund=5.25)
+            self.assertFalse(self.paytrail_requests)
+
+            refund_tx = tx.with_context(
+                paytrail_refund_items=[{"stamp": "stamp-1", "amount": 525}]
+            )._send_refund_request(amount_to_refund=5.25)
+
+        method, path, payload = self.paytrail_requests[0]
+        self.assertEqual(path, "/payments/pt-sis/refund")
+        self.assertEqual(payload["amount"], 525)
+        self.assertEqual(len(payload["items"]), 1)
+        self.assertEqual(payload["items"][0]["stamp"], "stamp-1")
+        self.assertEqual(payload["items"][0]["amount"], 525)
+        self.assertEqual(refund_tx.state, "pending")
+
+    def test_refund_by_email(self):
+        self.paytrail.paytrail_refund_by_email = True
+        tx = self._create_paid_transaction("paytrail-email", "pt-email")
+
+        def handler(method, path, payload):
+            if path.endswith("/email"):
+                return MockResponse(
+                    201, {"transactionId": "pt-email-refund", "status": "pending"}
+                )
+            return MockResponse(
+                400, {"status": "error", "message": "Refund not supported"}
+            )
+
+        with self._mock_paytrail(handler):
+            refund_tx = tx._send_refund_request()
+
+        self.assertEqual(
+            [path for _method, path, _payload in self.paytrail_requests],
+            ["/payments/pt-email/refund", "/payments/pt-email/refund/email"],
+        )
+        self.assertEqual(self.paytrail_requests[1][2]["email"], self.partner.email)
+        self.assertEqual(refund_tx.provider_reference, "pt-email-refund")
+        self.assertEqual(refund_tx.state, "pending")
+
+    def test_refund_rejected_without_email(self):
+        tx = self._create_paid_transaction("paytrail-rejected", "pt-rejected")
+
+        def handler(method, path, payload):
+            return MockResponse(
+                400, {"status": "error", "message": "Refund not supported"}
+            )
+
+        with self._mock_paytrail(handler):
+            refund_tx = tx._send_refund_request()
+
+        self.assertEqual(len(self.paytrail_requests), 1)
+        self.assertEqual(refund_tx.state, "error")
+
+    def test_bulk_refund(self):
+        self.paytrail.paytrail_refund_by_email = True
+        tx_ok = self._create_paid_transaction("paytrail-bulk-1", "pt-bulk-1")
+        tx_email = self._create_paid_transaction("paytrail-bulk-2", "pt-bulk-2")
+        tx_refunded = self._create_paid_transaction("paytrail-bulk-3", "pt-bulk-3")
+        tx_refunded._create_child_transaction(
+            tx_refunded.amount, is_refund=True
+        )._set_done()
+        tx_draft = self._create_transaction("redirect", reference="paytrail-bulk-4")
+
+        (tx_ok | tx_email | tx_refunded | tx_draft).action_paytrail_refund_in_bulk()
+        self.assertEqual(tx_ok.refunds_count, 1)
+        self.assertEqual(tx_email.refunds_count, 1)
+        self.assertEqual(tx_refunded.refunds_count, 1)
+        self.assertEqual(tx_draft.refunds_count, 0)
+
+        def handler(method, path, payload):
+            if path == "/payments/pt-bulk-1/refund":
+                return MockResponse(201, {"transactionId": "pt-r1", "status": "ok"})
+            if path == "/payments/pt-bulk-2/refund/email":
+                return MockResponse(
+                    201, {"transactionId": "pt-r2", "status": "pending"}
+                )
+            return MockResponse(
+                400, {"status": "error", "message": "Refund not supported"}
+            )
+
+        Transaction = self.env["payment.transaction"]
+        with self._mock_paytrail(handler):
+            Transaction._cron_paytrail_send_refunds()
+
+        refund_ok = Transaction.search([("source_transaction_id", "=", tx_ok.id)])
+        refund_email = Transaction.search([("source_transaction_id", "=", tx_email.id)])
+        self.assertEqual(refund_ok.state, "done")
+        self.assertEqual(refund_ok.provider_reference, "pt-r1")
+        self.assertEqual(refund_email.state, "pending")
+        self.assertEqual(refund_email.provider_reference, "pt-r2")
+        self.assertEqual(
+            sorted(path for _method, path, _payload in self.paytrail_requests),
+            [
+                "/payments/pt-bulk-1/refund",
+                "/payments/pt-bulk-2/refund",
+                "/payments/pt-bulk-2/refund/email",
+            ],
+        )
+
+        # Refunds that have been sent are not sent again
+        with self._mock_paytrail(handler):
+            Transaction._cron_paytrail_send_refunds()
+        self.assertFalse(self.paytrail_requests)
+
+    def _get_refund_stamps(self):
+        return [payload["refundStamp"] for _m, _p, payload in self.paytrail_requests]
+
+    def test_interrupted_bulk_refund_is_not_paid_twice(self):
+        tx = self._create_paid_transaction("paytrail-interrupted", "pt-interrupted")
+        tx.action_paytrail_refund_in_bulk()
+        Transaction = self.env["payment.transaction"]
+        refund_tx = Transaction.search([("source_transaction_id", "=", tx.id)])
+
+        # Paytrail accepts the refund, but applying it fails
+        with self._mock_paytrail(
+            lambda method, path, payload: MockResponse(
+                201, {"transactionId": "pt-refund", "status": "ok"}
+            )
+        ), patch.object(
+            type(refund_tx),
+            "_paytrail_process_refund_response",
+            side_effect=ValueError("Interrupted"),
+        ), self.assertLogs(
+            "odoo.addons.payment_paytrail_nets.models.payment_transaction",
+            level="ERROR",
+        ):
+            Transaction._cron_paytrail_send_refunds()
+        self.assertEqual(refund_tx.state, "draft")
+        stamps = self._get_refund_stamps()
+
+        # The next run sends the same stamp, which Paytrail rejects as a
+        # duplicate
+        def handler(method, path, payload):
+            return MockResponse(
+                409,
+                {
+                    "status": "error",
+                    "message": "Duplicate refund stamp",
+                    "transactionId": "pt-refund",
+                },
+            )
+
+        with self._mock_paytrail(handler):
+            Transaction._cron_paytrail_send_refunds()
+
+        self.assertEqual(self._get_refund_stamps(), stamps)
+        self.assertEqual(stamps, [refund_tx.paytrail_checkout_stamp])
+        self.assertEqual(refund_tx.state, "pending")
+        self.assertEqual(refund_tx.provider_reference, "pt-refund")
+
+    def test_bulk_refund_paytrail_unavailable(self):
+        tx = self._create_paid_transaction("paytrail-unavailable", "pt-unavailable")
+        tx.action_paytrail_refund_in_bulk()
+        Transaction = self.env["payment.transaction"]
+        refund_tx = Transaction.search([("source_transaction_id", "=", tx.id)])
+
+        def handler(method, path, payload):
+            raise paytrail_utils.PaytrailUnavailable("Circuit is open")
+
+        with self._mock_paytrail(handler):
+            Transaction._cron_paytrail_send_refunds()
+        self.assertEqual(refund_tx.state, "draft")
+        stamps = self._get_refund_stamps()
+
+        # Refunds that were not sent are sent by the next run
+        with self._mock_paytrail(
+            lambda method, path, payload: MockResponse(
+                201, {"transactionId": "pt-refund", "status": "ok"}
+            )
+        ):
+            Transaction._cron_paytrail_send_refunds()
+        self.assertEqual(self._get_refund_stamps(), stamps)
+        self.assertEqual(refund_tx.state, "done")
+        self.assertEqual(refund_tx.provider_reference, "pt-refund")
@@ -0,0 +1,41 @@
+from odoo.tests import tagged
+
+from odoo.addons.payment_paytrail_nets.tests.common import PaytrailCommon
+
+
+@tagged("post_install", "-at_install")
+class TestPaytrailSettlement(PaytrailCommon):
+    def test_import_payment_report_amounts(self):
+        Settlement = self.env["paytrail.settlement"]
+        settlement = Settlement._import_settlements(
+            self.paytrail,
+            [
+                {
+                    "id": "settlement-1",
+                    "settlementReference": "1232",
+                    "transactionIds": ["pt-cents", "pt-euros", "pt-invalid"],
+                }
+            ],
+        )
+        lines = {line.paytrail_transaction_id: line for line in settlement.line_ids}
+        lines["pt-invalid"].amount = 3.5
+
+        with self.assertLogs(
+            "odoo.addons.payment_paytrail_nets.models.paytrail_settlement",
+            level="WARNING",
+        ):
+            updated = Settlement._import_payment_report(
+                self.paytrail,
+                [
+                    {"transactionId": "pt-cents", "status": "ok", "amount": "1525"},
+                    {"transactionId": "pt-euros", "status": "ok", "amount": "12.50"},
+                    {"transactionId": "pt-invalid", "status": "ok", "amount": "n/a"},
+                ],
+            )
+
+        self.assertEqual(updated, 3)
+        self.assertEqual(lines["pt-cents"].amount, 15.25)
+        self.assertEqual(lines["pt-euros"].amount, 12.5)
+        # Amounts that cannot be parsed are not overwritten
+        self.assertEqual(lines["pt-invalid"].amount, 3.5)
+        self.assertEqual(lines["pt-invalid"].status, "ok")
@@ -0,0 +1,186 @@
+from unittest.mock import patch
+
+from odoo import Command
+from odoo.tests import tagged
+
+from odoo.addons.payment_paytrail_nets import const, utils as paytrail_utils
+from odoo.addons.payment_paytrail_nets.tests.common import (
+    MockResponse,
+    PaytrailCommon,
+)
+
+CHARGE_PATH = "/payments/token/mit/charge"
+
+
+@tagged("post_install", "-at_install")
+class TestPaytrailTokenCharge(PaytrailCommon):
+    def setUp(self):
+        super().setUp()
+        self.token = self.env["payment.token"].create(
+            {
+                "provider_id": self.paytrail.id,
+                "payment_method_id": self.payment_method_id,
+                "payment_details": "0024",
+                "partner_id": self.partner.id,
+                "provider_ref": "c7441208-c2a1-4a10-8eb6-458bd8eaa65f",
+            }
+        )
+        # Retries are not waited for
+        sleep_patcher = patch(
+            "odoo.addons.payment_paytrail_nets.models.payment_transaction.time.sleep"
+        )
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def _create_token_transaction(self, reference):
+        order = self._create_order()
+        return self._create_transaction(
+            "direct",
+            reference=reference,
+            operation="offline",
+            amount=order.amount_total,
+            token_id=self.token.id,
+            sale_order_ids=[Command.set(order.ids)],
+        )
+
+    def _get_charge_stamps(self):
+        return [
+            payload["stamp"]
+            for _method, path, payload in self.paytrail_requests
+            if path == CHARGE_PATH
+        ]
+
+    def test_charge_retried_with_same_stamp(self):
+        tx = self._create_token_transaction("paytrail-retry")
+        responses = iter(
+            [
+                MockResponse(503, {"status": "error", "message": "Unavailable"}),
+                MockResponse(201, {"transactionId": "pt-retry"}),
+            ]
+        )
+
+        with self._mock_paytrail(lambda method, path, payload: next(responses)):
+            tx._paytrail_charge_tokens_in_bulk()
+
+        stamps = self._get_charge_stamps()
+        self.assertEqual(len(stamps), 2)
+        self.assertEqual(stamps[0], stamps[1])
+        self.assertEqual(stamps[0], tx.paytrail_checkout_stamp)
+        self.assertEqual(self.sleep.call_count, 1)
+        self.assertEqual(tx.state, "done")
+        self.assertEqual(tx.provider_reference, "pt-retry")
+
+    def test_interrupted_charge_is_not_created_twice(self):
+        tx = self._create_token_transaction("paytrail-interrupted")
+
+        # Paytrail takes the charge, but applying it fails
+        with self._mock_paytrail(
+            lambda method, path, payload: MockResponse(
+                201, {"transactionId": "pt-interrupted"}
+            )
+        ), patch.object(
+            type(tx),
+            "_paytrail_process_token_charge_response",
+            side_effect=ValueError("Interrupted"),
+        ), self.assertLogs(
+            "odoo.addons.payment_paytrail_nets.models.payment_transaction",
+            level="ERROR",
+        ):
+            tx._paytrail_charge_tokens_in_bulk()
+        self.assertEqual(tx.state, "draft")
+        stamp = tx.paytrail_checkout_stamp
+        self.assertTrue(stamp)
+
+        # The next run sends the same stamp, which Paytrail rejects as a
+        # duplicate. The payment is then looked up.
+        payment_response = self._signed_response(
+            200,
+            {
+                "id": "pt-interrupted",
+                "status": "ok",
+                "stamp": stamp,
+                "reference": tx.reference,
+                "provider": "nordea",
+            },
+        )
+
+        def handler(method, path, payload):
+            if path == CHARGE_PATH:
+                return MockResponse(
+                    409,
+                    {
+                        "status": "error",
+                        "message": "Duplicate stamp",
+                        "transactionId": "pt-interrupted",
+                    },
+                )
+            return payment_response
+
+        with self._mock_paytrail(handler):
+            tx._paytrail_charge_tokens_in_bulk()
+
+        self.assertEqual(
+            [path for _method, path, _payload in self.paytrail_requests],
+            [CHARGE_PATH, "/payments/pt-interrupted"],
+        )
+        self.assertEqual(self._get_charge_stamps(), [stamp])
+        self.assertEqual(tx.state, "done")
+        self.assertEqual(tx.provider_reference, "pt-interrupted")
+
+    def test_charge_stopped_when_paytrail_unavailable(self):
+        tx = self._create_token_transaction("paytrail-unavailable")
+
+        def handler(method, path, payload):
+            raise paytrail_utils.PaytrailUnavailable("Circuit is open")
+
+        with self._mock_paytrail(handler):
+            tx._paytrail_charge_tokens_in_bulk()
+
+        self.assertEqual(len(self.paytrail_requests), 1)
+        self.sleep.assert_not_called()
+        self.assertEqual(tx.state, "draft")
+        self.assertTrue(tx.paytrail_checkout_stamp)
+
+    def test_soft_decline_charged_on_later_run(self):
+        tx = self._create_token_transaction("paytrail-soft-decline")
+        declined = MockResponse(
+            400,
+            {
+                "status": "error",
+                "message": "Insufficient funds",
+                "acquirerResponseCode": "51",
+            },
+        )
+
+        stamps = []
+        for _i in range(const.TOKEN_CHARGE_MAX_SOFT_DECLINES):
+            with self._mock_paytrail(lambda method, path, payload: declined):
+                tx._paytrail_charge_tokens_in_bulk()
+            # Soft declines are not retried within the run
+            self.assertEqual(len(self.paytrail_requests), 1)
+            stamps += self._get_charge_stamps()
+
+        self.sleep.assert_not_called()
+        # The declined payment is final, every run charges with a new stamp
+        self.assertEqual(len(set(stamps)), const.TOKEN_CHARGE_MAX_SOFT_DECLINES)
+        self.assertEqual(
+            tx.paytrail_soft_declines, const.TOKEN_CHARGE_MAX_SOFT_DECLINES
+        )
+        self.assertEqual(tx.state, "error")
+
+    def test_hard_decline(self):
+        tx = self._create_token_transaction("paytrail-hard-decline")
+        declined = MockResponse(
+            400,
+            {
+                "status": "error",
+                "message": "Card expired",
+                "acquirerResponseCode": "54",
+            },
+        )
+
+        with self._mock_paytrail(lambda method, path, payload: declined):
+            tx._paytrail_charge_tokens_in_bulk()
+
+        self.assertEqual(len(self.paytrail_requests), 1)
+        self.assertEqual(tx.state, "error")
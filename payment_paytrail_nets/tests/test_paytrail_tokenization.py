@@ -0,0 +1,89 @@
+from urllib.parse import urlencode
+
+from odoo import Command
+from odoo.tests import tagged
+
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment_paytrail_nets.controllers.main import PaytrailController
+from odoo.addons.payment_paytrail_nets.tests.common import (
+    MockResponse,
+    PaytrailCommon,
+)
+
+
+@tagged("post_install", "-at_install")
+class TestPaytrailTokenization(PaytrailCommon):
+    def _get_tokenization_return_url(self, tx):
+        data = {
+            "checkout-account": self.paytrail.paytrail_merchant_id,
+            "checkout-algorithm": "sha256",
+            "checkout-method": "POST",
+            "checkout-tokenization-id": "818c478e-5682-46bf-97fd-b9c2b93a3fcd",
+            "checkout-status": "ok",
+        }
+        data["signature"] = self.paytrail._paytrail_compute_signature(data, "")
+        data["reference"] = tx.reference
+        data["access_token"] = payment_utils.generate_access_token(tx.reference)
+        return (
+            f"{self._build_url(PaytrailController._tokenization_url)}?"
+            f"{urlencode(data)}"
+        )
+
+    def _handle_paytrail_request(self, method, path, payload):
+        if path.startswith("/tokenization/"):
+            return MockResponse(
+                200,
+                {
+                    "token": "c7441208-c2a1-4a10-8eb6-458bd8eaa65f",
+                    "card": {"type": "Visa", "partial_pan": "0024"},
+                },
+            )
+        if path == "/payments/token/cit/charge":
+            return MockResponse(
+                201, {"transactionId": "f3d9fe52-1ba4-4b1c-8ee3-bc5c4e2d2a3a"}
+            )
+        return MockResponse(404, {"status": "error", "message": "Not found"})
+
+    def test_return_from_tokenization_is_processed_once(self):
+        order = self._create_order()
+        tx = self._create_transaction(
+            "redirect",
+            reference="paytrail-tokenization",
+            amount=order.amount_total,
+            tokenize=True,
+            sale_order_ids=[Command.set(order.ids)],
+        )
+        url = self._get_tokenization_return_url(tx)
+
+        with self._mock_paytrail(self._handle_paytrail_request):
+            response = self.url_open(url, allow_redirects=False)
+            self.assertEqual(response.status_code, 303)
+            self.assertEqual(
+                [path for _method, path, _payload in self.paytrail_requests],
+                [
+                    "/tokenization/818c478e-5682-46bf-97fd-b9c2b93a3fcd",
+                    "/payments/token/cit/charge",
+                ],
+            )
+            tx.invalidate_recordset()
+            self.assertEqual(tx.state, "done")
+            token = tx.token_id
+            self.assertTrue(token)
+
+            # Reloading the page must not save the card nor charge it again
+            response = self.url_open(url, allow_redirects=False)
+            self.assertEqual(response.status_code, 303)
+            self.assertTrue(response.headers["Location"].endswith("/payment/status"))
+
+        self.assertEqual(len(self.paytrail_requests), 2)
+        tx.invalidate_recordset()
+        self.assertEqual(tx.token_id, token)
+        self.assertEqual(
+            self.env["payment.token"].search_count(
+                [
+                    ("partner_id", "=", self.partner.id),
+                    ("provider_id", "=", tx.provider_id.id),
+                ]
+            ),
+            1,
+        )
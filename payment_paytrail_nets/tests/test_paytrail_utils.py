@@ -0,0 +1,57 @@
+import json
+
+from odoo.tests import tagged
+from odoo.tests.common import BaseCase
+
+from odoo.addons.payment_paytrail_nets import utils as paytrail_utils
+
+SETTLEMENTS = [
+    {
+        "id": "a3a38ff8-3f35-4c11-a2a4-7d8c7d3b0f1e",
+        "settlementReference": "1232",
+        "transactionIds": ["5770642a-9a02-4ca2-8eaa-cc6260a78eb6"],
+        "amount": 15.25,
+        "fee": -1.5e-1,
+        "count": 12,
+        "description": "Tilitys ä€",
+        "final": True,
+        "note": None,
+    },
+    3.25,
+    -12,
+    1e3,
+    "],",
+]
+
+
+@tagged("post_install", "-at_install")
+class TestPaytrailUtils(BaseCase):
+    def _parse(self, chunks):
+        return list(paytrail_utils.iter_json_array(chunks))
+
+    def test_iter_json_array_chunk_boundaries(self):
+        content = json.dumps(SETTLEMENTS, ensure_ascii=False).encode("utf-8")
+        expected = json.loads(content)
+        for size in range(1, len(content) + 1):
+            chunks = [
+                content[start : start + size] for start in range(0, len(content), size)
+            ]
+            self.assertEqual(self._parse(chunks), expected, f"Chunk size {size}")
+        for split in range(len(content) + 1):
+            self.assertEqual(
+                self._parse([content[:split], content[split:]]),
+                expected,
+                f"Split at {split}",
+            )
+
+    def test_iter_json_array_number_split(self):
+        self.assertEqual(self._parse([b"[1.", b"5]"]), [1.5])
+        self.assertEqual(self._parse([b"[12", b".5, 2e", b"3]"]), [12.5, 2000.0])
+
+    def test_iter_json_array_invalid(self):
+        with self.assertRaises(ValueError):
+            self._parse([b'{"id": 1}'])
+        with self.assertRaises(ValueError):
+            self._parse([b"[1, 2"])
+        with self.assertRaises(ValueError):
+            self._parse([b"[1."])
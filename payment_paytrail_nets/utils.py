@@ -0,0 +1,440 @@
+import codecs
+import hashlib
+import hmac
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from odoo.addons.payment_paytrail_nets import const
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# Worker-level pool of HTTP sessions, one per merchant account. Sessions keep
+# their connections alive, so consecutive requests skip the TCP and TLS handshakes.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Rate limiters and circuit breakers, one per merchant account. Their state is
+# shared between the workers of the server.
+_guards = {}
+_guards_lock = threading.Lock()
+
+# Worker-level executor for requests that are sent in the background
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _build_session():
+    """
+    Build a new HTTP session with retry policy and connection pooling
+
+    :return: requests.Session
+    """
+    retry = Retry(
+        total=const.RETRY_TOTAL,
+        backoff_factor=const.RETRY_BACKOFF_FACTOR,
+        status_forcelist=const.RETRY_STATUSES,
+        allowed_methods=frozenset(const.RETRY_METHODS),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        max_retries=retry,
+        pool_connections=1,
+        pool_maxsize=const.POOL_MAXSIZE,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(merchant_id):
+    """
+    Get the pooled HTTP session of a merchant account
+
+    :param merchant_id: string
+    :return: requests.Session
+    """
+    session = _sessions.get(merchant_id)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(merchant_id)
+            if session is None:
+                session = _sessions[merchant_id] = _build_session()
+    return session
+
+
+def get_guard(merchant_id):
+    """
+    Get the rate limiter and circuit breaker of a merchant account
+
+    :param merchant_id: string
+    :return: PaytrailGuard
+    """
+    guard = _guards.get(merchant_id)
+    if guard is None:
+        with _guards_lock:
+            guard = _guards.get(merchant_id)
+            if guard is None:
+                guard = _guards[merchant_id] = PaytrailGuard(merchant_id)
+    return guard
+
+
+def send_request(
+    merchant_id,
+    method,
+    url,
+    headers,
+    data=None,
+    max_wait=const.RATE_LIMIT_MAX_WAIT,
+    stream=False,
+):
+    """
+    Send a request to Paytrail using the pooled session of the merchant account.
+
+    Requests are paced by the rate limiter of the merchant account, and fail
+    fast without contacting Paytrail while its circuit breaker is open.
+
+    :param merchant_id: string
+    :param method: string, HTTP method
+    :param url: string
+    :param headers: dict
+    :param data: request body
+    :param max_wait: float, seconds to wait for the rate limit, None to wait
+        as long as needed
+    :param stream: bool, if set, the content is read only when iterated over
+    :return: requests.Response
+    :raise: PaytrailUnavailable if the request was not sent
+    """
+    guard = get_guard(merchant_id)
+    guard.acquire(max_wait)
+    try:
+        response = get_session(merchant_id).request(
+            method,
+            url,
+            headers=headers,
+            data=data,
+            timeout=(const.CONNECT_TIMEOUT, const.READ_TIMEOUT),
+            stream=stream,
+        )
+    except requests.exceptions.RequestException:
+        guard.record_result(False)
+        raise
+    guard.record_result(response.status_code < 500 and response.status_code != 429)
+    return response
+
+
+def send_requests(prepared_requests, max_workers):
+    """
+    Send several requests concurrently with a bounded thread pool. Requests
+    wait for the rate limit as long as needed.
+
+    :param prepared_requests: list of dicts, see send_request
+    :param max_workers: int
+    :return: list of requests.Response, or the raised exception for requests
+        that failed, in the same order as the prepared requests
+    """
+
+    def _send(prepared_request):
+        try:
+            return send_request(**prepared_request, max_wait=None)
+        except requests.exceptions.RequestException as e:
+            return e
+
+    if not prepared_requests:
+        return []
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(prepared_requests)),
+        thread_name_prefix="paytrail-batch",
+    ) as executor:
+        return list(executor.map(_send, prepared_requests))
+
+
+def encode_payload(payload):
+    """
+    Serialize a payload to compact JSON bytes. The same bytes are used both for
+    the signature and as the request body.
+
+    :param payload: dict
+    :return: bytes
+    """
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode(
+        "utf-8"
+    )
+
+
+# Characters that can continue a JSON number
+_NUMBER_CHARACTERS = frozenset("0123456789.eE+-")
+
+
+def iter_json_array(chunks):
+    """
+    Parse a JSON array from chunks of bytes, yielding its elements one by one
+    without loading the whole document in memory
+
+    :param chunks: iterable of bytes
+    :return: generator of the array elements
+    :raise: ValueError if the content is not a JSON array
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                break
+            if not started:
+                if buffer[0] != "[":
+                    raise ValueError("Content is not a JSON array")
+                started = True
+                buffer = buffer[1:]
+            elif buffer[0] == ",":
+                buffer = buffer[1:]
+            elif buffer[0] == "]":
+                return
+            else:
+                try:
+                    element, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    # Element continues in the next chunk
+                    break
+                if end == len(buffer) or (
+                    isinstance(element, (int, float))
+                    and buffer[end] in _NUMBER_CHARACTERS
+                ):
+                    # Element may continue in the next chunk, e.g. a number
+                    # split after its decimal point or exponent
+                    break
+                yield element
+                buffer = buffer[end:]
+    raise ValueError("Unexpected end of JSON array")
+
+
+def parse_response(response):
+    """
+    Get the JSON content of a Paytrail response
+
+    :param response: requests.Response
+    :return: dict, or an error dict if the content is not valid JSON
+    """
+    try:
+        return response.json()
+    except ValueError:
+        return {
+            "status": "error",
+            "message": f"Unexpected response ({response.status_code})",
+        }
+
+
+def submit_background(func, *args):
+    """
+    Run a function in the worker-level background executor
+
+    :param func: callable
+    :return: concurrent.futures.Future
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=const.BACKGROUND_WORKERS,
+                    thread_name_prefix="paytrail",
+                )
+    return _executor.submit(func, *args)
+
+
+class PaytrailSigner:
+    """Computes Paytrail HMAC signatures with a pre-keyed HMAC state"""
+
+    __slots__ = ("_hmac",)
+
+    def __init__(self, secret):
+        self._hmac = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+
+    def start(self, headers):
+        """
+        Start a Paytrail HMAC signature from the headers. The payload can then
+        be added in parts, e.g. while streaming a response.
+
+        :param headers: dict
+        :return: hmac.HMAC
+        """
+        mac = self._hmac.copy()
+        for key in sorted(key for key in headers if key.startswith("checkout-")):
+            mac.update(b"%s:%s\n" % (key.encode(), str(headers[key]).encode()))
+        return mac
+
+    def sign(self, headers, payload):
+        """
+        Get Paytrail HMAC signature
+
+        Calculation uses all headers named "checkout-" in alphabetical order,
+        each followed by a line feed, and the payload.
+
+        :param headers: dict
+        :param payload: string or bytes
+        :return: string
+        """
+        mac = self.start(headers)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        mac.update(payload)
+        return mac.hexdigest()
+
+
+# Immutable snapshot of the Paytrail configuration of a provider, so that hot
+# paths do not read the provider record
+PaytrailConfig = namedtuple(
+    "PaytrailConfig",
+    [
+        "merchant_id",
+        "signer",
+        "base_url",
+        "api_url",
+        "shop_in_shop",
+        "default_sub_merchant_id",
+        "show_provider_buttons",
+        "async_payment_creation",
+        "queue_callbacks",
+    ],
+)
+
+
+class PaytrailUnavailable(requests.exceptions.RequestException):
+    """Request was not sent, as Paytrail is failing or the rate limit was hit"""
+
+
+class PaytrailGuard:
+    """Token bucket rate limiter and circuit breaker of a merchant account.
+
+    State is kept in a locked file, so that it is shared between the worker
+    processes and threads of the server.
+    """
+
+    def __init__(self, name):
+        name = re.sub(r"[^\w-]", "_", name)
+        self.path = os.path.join(tempfile.gettempdir(), f"odoo-paytrail-{name}.json")
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _state(self):
+        with self._lock, open(self.path, "a+", encoding="utf-8") as state_file:
+            if fcntl:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            content = state_file.read()
+            try:
+                state = json.loads(content) if content else {}
+            except ValueError:
+                state = {}
+            original_state = dict(state)
+            yield state
+            if state != original_state:
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                state_file.flush()
+
+    def acquire(self, max_wait=None):
+        """
+        Wait until a request is allowed
+
+        :param max_wait: float, seconds to wait at most, None to wait as long as
+            needed
+        :return: None
+        :raise: PaytrailUnavailable if the circuit is open, or the request is not
+            allowed within max_wait
+        """
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            with self._state() as state:
+                now = time.time()
+                if state.get("opened_until", 0) > now:
+                    raise PaytrailUnavailable("Paytrail is failing, circuit is open")
+
+                tokens = min(
+                    const.RATE_LIMIT_BURST,
+                    state.get("tokens", const.RATE_LIMIT_BURST)
+                    + (now - state.get("updated", now)) * const.RATE_LIMIT_PER_SECOND,
+                )
+                state["updated"] = now
+                if tokens >= 1:
+                    state["tokens"] = tokens - 1
+                    return
+                state["tokens"] = tokens
+                wait = (1 - tokens) / const.RATE_LIMIT_PER_SECOND
+
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise PaytrailUnavailable("Paytrail rate limit exceeded")
+            time.sleep(wait)
+
+    def record_result(self, success):
+        """
+        Record the result of a request. After too many consecutive failures,
+        the circuit is opened and requests fail fast for a while.
+
+        :param success: bool
+        :return: None
+        """
+        with self._state() as state:
+            if success:
+                state.pop("failures", None)
+                return
+            state["failures"] = state.get("failures", 0) + 1
+            if state["failures"] >= const.CIRCUIT_FAILURE_THRESHOLD:
+                state["opened_until"] = time.time() + const.CIRCUIT_COOLDOWN_SECONDS
+
+
+class TTLCache:
+    """Small thread-safe in-process cache with expiring keys"""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def set(self, key, value=True):
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                self._evict()
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def _evict(self):
+        # Drop expired entries, and the oldest half if the cache is still full
+        now = time.monotonic()
+        self._data = {k: v for k, v in self._data.items() if v[0] >= now}
+        if len(self._data) >= self.maxsize:
+            entries = sorted(self._data.items(), key=lambda item: item[1][0])
+            self._data = dict(entries[len(entries) // 2 :])